@@ -33,8 +33,12 @@ from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.outputs import OutputRaster
 
 from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterRaster
 from processing.core.parameters import ParameterNumber
 from processing.core.parameters import ParameterExtent
+from processing.core.parameters import ParameterString
+from processing.core.parameters import ParameterSelection
+from processing.core.parameters import ParameterBoolean
 
 
 class PSEWSpeedAlg:
@@ -46,11 +50,17 @@ class PSEWSpeedAlg:
             desc_input_path,
             extent,
             point_size,
-            cd_e_asc,
+            cd_e_asc,                     # number or raster path (see utils.cosine_director)
             cd_h_asc,
             cd_e_desc,
             cd_h_desc,
-            output_path):
+            output_path,
+            vel_field='VEL',
+            aggregation='mean',
+            grids=None,
+            grid_cache=False,
+            output_profile='deflate',
+            scratch_dir=None):
               
         self.asc_input_path = asc_input_path
         self.desc_input_path = desc_input_path
@@ -65,57 +75,75 @@ class PSEWSpeedAlg:
         
         self.output_path = output_path
 
+        self.vel_field = vel_field
+        self.aggregation = aggregation    # one of utils.GRID_AGGREGATIONS
+        self.grids = grids                # None or dictionary utils.grid_key:array
+                                          # of grids shared between runs
+        self.grid_cache = grid_cache      # keep the grids in utils.GRID_CACHE_DIR
+        self.output_profile = output_profile  # one of utils.OUTPUT_PROFILE_NAMES
+        self.scratch_dir = scratch_dir        # see utils.create_output
+
     def _save(self, array):
         # create the output image
-        driver = gdal.GetDriverByName('GTiff')
-        dst = driver.Create(
+        dst = utils.create_output(
               self.output_path,
               self.cols,                    
               self.rows,
               1,                        # number of bands
-              gdal.GDT_Float32)         # data type
+              gdal.GDT_Float32,         # data type
+              self.output_profile,
+              scratch_dir=self.scratch_dir)
 
-        # set geotrasform and projection
-        new_ulx, new_uly, new_lrx, new_lry = self.extent
-        dst.SetGeoTransform([new_ulx, self.point_size, 0, new_uly, self.point_size])
-        #dst.SetProjection( gdal.Open("/tmp/ascending_raster.tiff").GetProjection() )
-        #
+        try:
+            # set geotrasform and projection
+            xmin, ymin, xmax, ymax = self.extent        # north up, as utils.grid_points
+            dst.SetGeoTransform([xmin, self.point_size, 0, ymax, 0, -self.point_size])
+            #dst.SetProjection( gdal.Open("/tmp/ascending_raster.tiff").GetProjection() )
+            #
         
-        self.bandOut = dst.GetRasterBand(1)
-        self.bandOut.SetNoDataValue(-3.4e+38)
-        #bandOut.SetStatistics(
-        #          self.min,
-        #          self.max,
-        #          numpy.mean([self.max, self.min]),
-        #          self.std)
+            self.bandOut = dst.GetRasterBand(1)
+            self.bandOut.SetNoDataValue(-3.4e+38)
+            #bandOut.SetStatistics(
+            #          self.min,
+            #          self.max,
+            #          numpy.mean([self.max, self.min]),
+            #          self.std)
                   
-        self.bandOut.WriteArray(array)
-        self.bandOut.FlushCache()
+            array[numpy.isnan(array)] = -3.4e+38     # empty cells
+            utils.write_output(dst, array)
+            self.bandOut.FlushCache()
+            utils.finish_output(dst, self.output_profile)
+        finally:
+            # the output is ended on error too
+            intermediate_path = utils.discard_output(dst)
+            self.bandOut = None
+            dst = None                      # close the file
+            utils.close_output(intermediate_path)
 
     def compute(self):
         #
         
         # Feature to Raster
-        ras_asc_path = "/tmp/ascending_raster.tiff"    # tmp file, Ras -> Raster
-        utils.rasterize(self.asc_input_path, ras_asc_path, self.point_size)     
-        clipped_asc_array = utils.clip_from_extent_as_array(ras_asc_path, self.extent)
-        
-        ras_desc_path = "/tmp/descending_raster.tiff"  # tmp file
-        utils.rasterize(self.desc_input_path, ras_desc_path, self.point_size)   
-        clipped_desc_array = utils.clip_from_extent_as_array(ras_desc_path, self.extent)
-
-        # Constant images
-        self.rows, self.cols = clipped_asc_array.shape
-        CosDir1_array = self.cd_e_desc * numpy.ones((self.rows, self.cols), dtype=numpy.byte)
-        CosDir2_array = self.cd_h_desc * numpy.ones((self.rows, self.cols), dtype=numpy.byte)
-        CosDir3_array = self.cd_e_asc * numpy.ones((self.rows, self.cols), dtype=numpy.byte)
-        CosDir4_array = self.cd_h_asc * numpy.ones((self.rows, self.cols), dtype=numpy.byte)
+        gridded_asc_array = utils.shared_grid_point_file(
+                self.asc_input_path, self.vel_field, self.extent, self.point_size,
+                self.aggregation, self.grids, self.grid_cache)
+        gridded_desc_array = utils.shared_grid_point_file(
+                self.desc_input_path, self.vel_field, self.extent, self.point_size,
+                self.aggregation, self.grids, self.grid_cache)
 
+        # The constant images are folded in two scalar coefficients (when
+        # the cosine directors are numbers):
         # "(([ResDisc] div [CosDir2])  - ([ResAsc] div ([CosDir4])) ) div (([CosDir1] div [CosDir2]) - ([CosDir3] div ([CosDir4])))"
-        num = ((clipped_desc_array / CosDir2_array) - (clipped_asc_array / CosDir4_array))
-        den = ((CosDir1_array / CosDir2_array) - (CosDir3_array / CosDir4_array))           # for den == [0...] -> wrong image
-        ew_speed_array = num / den
-              
+        self.rows, self.cols = gridded_asc_array.shape
+        # (the cosine directors may be rasters, read a chunk of rows at a time)
+        ew_speed_array = utils.solve_speed(
+                gridded_asc_array,
+                gridded_desc_array,
+                (self.cd_e_asc, self.cd_h_asc, self.cd_e_desc, self.cd_h_desc),
+                self.extent,
+                self.point_size,
+                0)     # east-west
+
         self._save(ew_speed_array)
 
     def __enter__(self):
@@ -126,10 +154,7 @@ class PSEWSpeedAlg:
         #self.imageOut.SetGeoTransform(self.imageIn.GetGeoTransform())
         #self.imageOut.SetProjection(self.imageIn.GetProjection())
 
-        ## build pyramids for the output
-        #gdal.SetConfigOption('HFA_USE_RRD', 'YES')
-        #self.imageOut.BuildOverviews(overviewlist=[2,4,8,16])
-        # del dst???
+        # the overviews are written with the output (see utils.write_output)
         pass
 
 
@@ -141,11 +166,18 @@ class PSEWSpeedGeoAlg(GeoAlgorithm):
     
     EXTENT = "EXTENT"                     
     POINT_SIZE = "POINT_SIZE"            
+    VEL_FIELD = "VEL_FIELD"
+    AGGREGATION = "AGGREGATION"
+    GRID_CACHE = "GRID_CACHE"
     
     COSENO_DIRETTORE_E_ASCENDENTE = "CD_E_ASC"
     COSENO_DIRETTORE_H_ASCENDENTE = "CD_H_ASC"
     COSENO_DIRETTORE_E_DISCENDENTE = "CD_E_DISC"  # Cosine Director East Descending
     COSENO_DIRETTORE_H_DISCENDENTE = "CD_H_DISC"  # ... H?
+    COSENO_DIRETTORE_E_ASCENDENTE_RASTER = "CD_E_ASC_RASTER"
+    COSENO_DIRETTORE_H_ASCENDENTE_RASTER = "CD_H_ASC_RASTER"
+    COSENO_DIRETTORE_E_DISCENDENTE_RASTER = "CD_E_DISC_RASTER"
+    COSENO_DIRETTORE_H_DISCENDENTE_RASTER = "CD_H_DISC_RASTER"
 
     OUTPUT_PATH = "OUTPUT_PATH"           # Raster
  
@@ -164,6 +196,17 @@ class PSEWSpeedGeoAlg(GeoAlgorithm):
                                           "Point Size", 
                                           minValue=1,
                                           default=25))
+        self.addParameter(ParameterString(PSEWSpeedGeoAlg.VEL_FIELD,
+                                          "Velocity Field",
+                                          default="VEL"))
+        self.addParameter(ParameterSelection(PSEWSpeedGeoAlg.AGGREGATION,
+                                             "Aggregation of the points in a cell",
+                                             utils.GRID_AGGREGATIONS,
+                                             default=0))
+        self.addParameter(ParameterBoolean(PSEWSpeedGeoAlg.GRID_CACHE,
+                                           "Keep the gridded points in the cache",
+                                           False))
+        utils.add_output_parameters(self)   # advanced
         
         self.addParameter(ParameterNumber(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE, 
                                           "Cosine Director East Ascending",
@@ -185,6 +228,18 @@ class PSEWSpeedGeoAlg(GeoAlgorithm):
                                           minValue=0.0, 
                                           maxValue=1.0,
                                           default=0.5))
+        self.addParameter(ParameterRaster(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE_RASTER,
+                                          "Cosine Director East Ascending Raster (in place of the number)",
+                                          optional=True))
+        self.addParameter(ParameterRaster(PSEWSpeedGeoAlg.COSENO_DIRETTORE_H_ASCENDENTE_RASTER,
+                                          "Cosine Director Horizontal Ascending Raster (in place of the number)",
+                                          optional=True))
+        self.addParameter(ParameterRaster(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_DISCENDENTE_RASTER,
+                                          "Cosine Director East Descending Raster (in place of the number)",
+                                          optional=True))
+        self.addParameter(ParameterRaster(PSEWSpeedGeoAlg.COSENO_DIRETTORE_H_DISCENDENTE_RASTER,
+                                          "Cosine Director Horizontal Descending Raster (in place of the number)",
+                                          optional=True))
         
 
         self.addOutput(OutputRaster(PSEWSpeedGeoAlg.OUTPUT_PATH, 
@@ -195,15 +250,23 @@ class PSEWSpeedGeoAlg(GeoAlgorithm):
         desc_input_path = str(self.getParameterValue(PSEWSpeedGeoAlg.DESC_INPUT))
         extent = utils.convert_parameter(self.getParameterValue(PSEWSpeedGeoAlg.EXTENT))
         point_size = self.getParameterValue(PSEWSpeedGeoAlg.POINT_SIZE)
-        cd_e_asc = self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE)
-        cd_h_asc = self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_H_ASCENDENTE)
-        cd_e_desc = self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_DISCENDENTE)
-        cd_h_desc = self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_H_DISCENDENTE)
+        vel_field = str(self.getParameterValue(PSEWSpeedGeoAlg.VEL_FIELD))
+        aggregation = utils.GRID_AGGREGATIONS[self.getParameterValue(PSEWSpeedGeoAlg.AGGREGATION)]
+        grid_cache = self.getParameterValue(PSEWSpeedGeoAlg.GRID_CACHE)
+        output_profile, block_cache, scratch_dir = utils.output_parameters(self)
+        cd_e_asc = (self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE_RASTER) or
+                    self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE))
+        cd_h_asc = (self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_H_ASCENDENTE_RASTER) or
+                    self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_H_ASCENDENTE))
+        cd_e_desc = (self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_DISCENDENTE_RASTER) or
+                     self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_E_DISCENDENTE))
+        cd_h_desc = (self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_H_DISCENDENTE_RASTER) or
+                     self.getParameterValue(PSEWSpeedGeoAlg.COSENO_DIRETTORE_H_DISCENDENTE))
         
         #...
         output_path = str(self.getOutputValue(PSEWSpeedGeoAlg.OUTPUT_PATH))
         
-        with PSEWSpeedAlg(
+        with utils.BlockCache(block_cache), PSEWSpeedAlg(
                 asc_input_path, 
                 desc_input_path,
                 extent,
@@ -212,5 +275,11 @@ class PSEWSpeedGeoAlg(GeoAlgorithm):
                 cd_h_asc,
                 cd_e_desc,
                 cd_h_desc,
-                output_path) as vel:
+                output_path,
+                vel_field,
+                aggregation,
+                None,
+                grid_cache,
+                output_profile,
+                scratch_dir) as vel:
             vel.compute()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+    PSLOSDecomposition.py
+    ---------------------
+    Date                 : October 2026
+    Copyright            : (C) 2026 by Riccardo Lemmi
+    Email                : riccardo at reflab dot com
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+__author__ = 'Riccardo Lemmi'
+__date__ = 'October 2026'
+__copyright__ = '(C) 2026, Riccardo Lemmi'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+
+import csv
+
+from osgeo import gdal
+import numpy
+
+import utils
+
+from processing.core.GeoAlgorithm import GeoAlgorithm
+from processing.core.outputs import OutputRaster
+
+from processing.core.parameters import ParameterFile
+from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterExtent
+from processing.core.parameters import ParameterString
+from processing.core.parameters import ParameterSelection
+from processing.core.parameters import ParameterBoolean
+
+
+# components solved by each model, the North one is poorly constrained
+# by the near polar orbits and can be left out
+LSQ_MODELS = ['ENU', 'EU']
+COMPONENT_NAMES = {'E': 'East', 'N': 'North', 'U': 'Up'}
+
+# columns of the manifest, 'weight' is optional (1: the same for all)
+MANIFEST_COLUMNS = ['path', 'cd_e', 'cd_n', 'cd_u', 'weight']
+
+# cells of the chunks solved at a time
+LSQ_CHUNK_CELLS = 256 * 1024
+
+
+def read_manifest(manifest_path):
+    # read the tracks of a CSV manifest (see MANIFEST_COLUMNS), return a
+    # list of dictionaries
+    tracks = []
+    with open(manifest_path, 'rb') as manifest:
+        for i, row in enumerate(csv.DictReader(manifest)):
+            row = dict((k.strip().lower(), v.strip()) for k, v in row.items() if k)
+            missing = [c for c in MANIFEST_COLUMNS[:-1] if not row.get(c)]
+            if missing:
+                raise Exception("Manifest row %d: missing %s" % (i + 1, ', '.join(missing)))
+
+            tracks.append({
+                'path': row['path'],
+                'cosine_directors': tuple(utils.cosine_director(row[c]) for c in ('cd_e', 'cd_n', 'cd_u')),
+                'weight': float(row.get('weight') or 1),
+            })
+    return tracks
+
+
+def solve_tracks(grids, cosine_directors, weights, extent, cell_size, model='ENU', max_condition=1e6):
+    """
+      Weighted least squares of the line of sight velocities of N tracks
+      for each cell of the grid
+          los_i = cd_e_i * E + cd_n_i * N + cd_u_i * U
+      @param grids            : gridded velocities of each track (rows, cols),
+                                nan for empty cells (see utils.grid_points)
+      @param cosine_directors : (cd_e, cd_n, cd_u) of each track, numbers or
+                                rasters (see utils.cosine_director)
+      @param weights          : weight of each track (e.g. 1 / variance)
+      @param extent           : xmin, ymin, xmax, ymax of the grids
+      @param model            : the components solved, one of LSQ_MODELS
+      @param max_condition    : the cells with a greater condition number of
+                                the normal matrix are left empty
+
+      @return: list of float32 arrays, one for each component of the model
+               then the weighted RMS of the residuals and the condition number
+    """
+    columns = ['ENU'.index(c) for c in model]
+    rows, cols = grids[0].shape
+    tracks, k = len(grids), len(columns)
+
+    outputs = [numpy.empty((rows, cols), dtype=numpy.float32) for i in range(k + 2)]
+    weights = numpy.asarray(weights, dtype=numpy.float64)[:, None]
+
+    step = max(1, LSQ_CHUNK_CELLS // max(1, cols))
+    for start in range(0, rows, step):
+        n = min(step, rows - start)
+        cells = n * cols
+
+        # velocities (tracks, cells) and design matrices (tracks, cells, k)
+        los = numpy.array([grid[start:start + n].ravel() for grid in grids], dtype=numpy.float64)
+        design = numpy.empty((tracks, cells, k), dtype=numpy.float64)
+        for i, cds in enumerate(cosine_directors):
+            for j, c in enumerate(columns):
+                design[i, :, j] = numpy.ravel(utils.grid_values(
+                        utils.cosine_director(cds[c]), extent, cell_size, start, n))
+
+        # the empty cells of a track have no weight
+        valid = ~(numpy.isnan(los) | numpy.isnan(design).any(axis=2))
+        w = numpy.where(valid, weights, 0.0)
+        los[~valid] = 0
+        design[~valid] = 0
+
+        # normal equations of all the cells
+        normal = numpy.einsum('ip,ipj,ipk->pjk', w, design, design)
+        rhs = numpy.einsum('ip,ip,ipj->pj', w, los, design)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            condition = numpy.linalg.cond(normal)
+        solved = numpy.isfinite(condition) & (condition <= max_condition)
+
+        x = numpy.empty((cells, k), dtype=numpy.float64)
+        x.fill(numpy.nan)
+        if solved.any():
+            x[solved] = numpy.linalg.solve(normal[solved], rhs[solved][..., None])[..., 0]
+
+        residuals = los - numpy.einsum('ipj,pj->ip', design, x)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            rms = numpy.sqrt((w * residuals ** 2).sum(axis=0) / w.sum(axis=0))
+
+        for j in range(k):
+            outputs[j][start:start + n] = x[:, j].reshape(n, cols)
+        outputs[k][start:start + n] = rms.reshape(n, cols)
+        outputs[k + 1][start:start + n] = condition.reshape(n, cols)
+
+    return outputs
+
+
+class PSLOSDecompositionAlg:
+    # Computation of the East, North and Up speed from N tracks
+
+    def __init__(
+            self,
+            manifest_path,
+            extent,
+            point_size,
+            output_path,
+            model='ENU',
+            max_condition=1e6,
+            vel_field='VEL',
+            aggregation='mean',
+            workers=1,
+            grid_cache=False,
+            output_profile='deflate',
+            scratch_dir=None):
+
+        self.manifest_path = manifest_path
+
+        self.extent = extent
+        self.point_size = point_size
+
+        self.output_path = output_path
+
+        self.model = model                # one of LSQ_MODELS
+        self.max_condition = max_condition
+        self.vel_field = vel_field
+        self.aggregation = aggregation    # one of utils.GRID_AGGREGATIONS
+        self.workers = workers            # 0: all the cores
+        self.grid_cache = grid_cache      # keep the grids in utils.GRID_CACHE_DIR
+        self.output_profile = output_profile  # one of utils.OUTPUT_PROFILE_NAMES
+        self.scratch_dir = scratch_dir        # see utils.create_output
+
+    def _save(self, arrays):
+        # create the output image, a band for each component, the residual
+        # and the condition number
+        descriptions = [COMPONENT_NAMES[c] for c in self.model] + ['Residual', 'Condition']
+
+        dst = utils.create_output(
+              self.output_path,
+              self.cols,
+              self.rows,
+              len(arrays),              # number of bands
+              gdal.GDT_Float32,         # data type
+              self.output_profile,
+              scratch_dir=self.scratch_dir)
+
+        try:
+            xmin, ymin, xmax, ymax = self.extent        # north up, as utils.grid_points
+            dst.SetGeoTransform([xmin, self.point_size, 0, ymax, 0, -self.point_size])
+
+            for i, array in enumerate(arrays):
+                bandOut = dst.GetRasterBand(i + 1)
+                bandOut.SetDescription(descriptions[i])
+                bandOut.SetNoDataValue(-3.4e+38)
+                array[~numpy.isfinite(array)] = -3.4e+38     # empty or unsolved cells
+                utils.write_output(dst, array, band=i + 1)
+                bandOut.FlushCache()
+
+            utils.finish_output(dst, self.output_profile)
+        finally:
+            # the output is ended on error too
+            intermediate_path = utils.discard_output(dst)
+            bandOut = None
+            dst = None                      # close the file
+            utils.close_output(intermediate_path)
+
+    def compute(self):
+        #
+        tracks = read_manifest(self.manifest_path)
+        if len(tracks) < len(self.model):
+            raise Exception("At least %d tracks are needed for %s" % (len(self.model), self.model))
+
+        # the tracks are gridded on the workers (the least squares need the
+        # grids of all of them at once)
+        keys = [utils.grid_key(track['path'], self.vel_field, self.extent, self.point_size, self.aggregation)
+                for track in tracks]
+        grids = utils.grid_point_files(keys, self.workers, self.grid_cache)
+        self.rows, self.cols = grids[0].shape
+
+        arrays = solve_tracks(
+                grids,
+                [track['cosine_directors'] for track in tracks],
+                [track['weight'] for track in tracks],
+                self.extent,
+                self.point_size,
+                self.model,
+                self.max_condition)
+
+        self._save(arrays)
+
+    def __enter__(self):
+        return  self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class PSLOSDecompositionGeoAlg(GeoAlgorithm):
+    """ East, North and Up speed from many tracks by weighted least squares """
+
+    MANIFEST = "MANIFEST"                 # CSV
+
+    EXTENT = "EXTENT"
+    POINT_SIZE = "POINT_SIZE"
+    MODEL = "MODEL"
+    MAX_CONDITION = "MAX_CONDITION"
+    VEL_FIELD = "VEL_FIELD"
+    AGGREGATION = "AGGREGATION"
+    WORKERS = "WORKERS"
+    GRID_CACHE = "GRID_CACHE"
+
+    OUTPUT_PATH = "OUTPUT_PATH"           # Raster, a band for each component
+
+    def defineCharacteristics(self):
+        self.name = "Model to compute East, North and Up components of speed for many tracks of PS points"
+        self.group = "[pstools]"
+
+        self.addParameter(ParameterFile(PSLOSDecompositionGeoAlg.MANIFEST,
+                                        "Manifest of the tracks (CSV: %s)" % ', '.join(MANIFEST_COLUMNS),
+                                        optional=False,
+                                        ext='csv'))
+
+        self.addParameter(ParameterExtent(PSLOSDecompositionGeoAlg.EXTENT,
+                                          "Extent"))
+        self.addParameter(ParameterNumber(PSLOSDecompositionGeoAlg.POINT_SIZE,
+                                          "Point Size",
+                                          minValue=1,
+                                          default=25))
+        self.addParameter(ParameterSelection(PSLOSDecompositionGeoAlg.MODEL,
+                                             "Components",
+                                             LSQ_MODELS,
+                                             default=0))
+        self.addParameter(ParameterNumber(PSLOSDecompositionGeoAlg.MAX_CONDITION,
+                                          "Max condition number of a cell",
+                                          minValue=1,
+                                          default=1e6))
+        self.addParameter(ParameterString(PSLOSDecompositionGeoAlg.VEL_FIELD,
+                                          "Velocity Field",
+                                          default="VEL"))
+        self.addParameter(ParameterSelection(PSLOSDecompositionGeoAlg.AGGREGATION,
+                                             "Aggregation of the points in a cell",
+                                             utils.GRID_AGGREGATIONS,
+                                             default=0))
+        self.addParameter(ParameterNumber(PSLOSDecompositionGeoAlg.WORKERS,
+                                          "Number of Workers (0: all the cores)",
+                                          minValue=0,
+                                          default=1))
+        self.addParameter(ParameterBoolean(PSLOSDecompositionGeoAlg.GRID_CACHE,
+                                           "Keep the gridded points in the cache",
+                                           False))
+        utils.add_output_parameters(self)   # advanced
+
+        self.addOutput(OutputRaster(PSLOSDecompositionGeoAlg.OUTPUT_PATH,
+                                    "East, North, Up Speed Image"))
+
+    def processAlgorithm(self, progress):
+        manifest_path = str(self.getParameterValue(PSLOSDecompositionGeoAlg.MANIFEST))
+        extent = utils.convert_parameter(self.getParameterValue(PSLOSDecompositionGeoAlg.EXTENT))
+        point_size = self.getParameterValue(PSLOSDecompositionGeoAlg.POINT_SIZE)
+        model = LSQ_MODELS[self.getParameterValue(PSLOSDecompositionGeoAlg.MODEL)]
+        max_condition = self.getParameterValue(PSLOSDecompositionGeoAlg.MAX_CONDITION)
+        vel_field = str(self.getParameterValue(PSLOSDecompositionGeoAlg.VEL_FIELD))
+        aggregation = utils.GRID_AGGREGATIONS[self.getParameterValue(PSLOSDecompositionGeoAlg.AGGREGATION)]
+        workers = self.getParameterValue(PSLOSDecompositionGeoAlg.WORKERS)
+        grid_cache = self.getParameterValue(PSLOSDecompositionGeoAlg.GRID_CACHE)
+        output_profile, block_cache, scratch_dir = utils.output_parameters(self)
+
+        output_path = str(self.getOutputValue(PSLOSDecompositionGeoAlg.OUTPUT_PATH))
+
+        with utils.BlockCache(block_cache), PSLOSDecompositionAlg(
+                manifest_path,
+                extent,
+                point_size,
+                output_path,
+                model,
+                max_condition,
+                vel_field,
+                aggregation,
+                workers,
+                grid_cache,
+                output_profile,
+                scratch_dir) as vel:
+            vel.compute()
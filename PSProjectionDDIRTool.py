@@ -24,10 +24,13 @@ __copyright__ = '(C) 2014, Riccardo Lemmi'
 __revision__ = '$Format:%H$'
 
 
+from collections import OrderedDict
+
 from osgeo import gdal, ogr
 import numpy
 
 import utils
+import kernels
 
 from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.outputs import OutputVector
@@ -36,6 +39,8 @@ from processing.core.outputs import OutputVector
 from processing.core.parameters import ParameterRaster
 from processing.core.parameters import ParameterVector
 from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterBoolean
+from processing.core.parameters import ParameterExtent
 
 
 class PSProjectionToolAlg:
@@ -49,7 +54,10 @@ class PSProjectionToolAlg:
             exp_clos,
             exp_dip,
             exp_dipdir,
-            ps_proj_path):
+            ps_proj_path,
+            constant_fields=False,
+            extent=None,
+            chunk_size=None):
 
         self.ps_input_path = ps_input_path
 
@@ -61,33 +69,43 @@ class PSProjectionToolAlg:
         self.exp_dipdir = exp_dipdir
         
         self.ps_proj_path= ps_proj_path
+        self.constant_fields = constant_fields  # write ALOS, BLOS, CLOS, dip, dipdir
+        self.extent = extent                    # None or only the points in xmin, ymin, xmax, ymax
+        self.chunk_size = chunk_size            # points for chunk, None for utils.STREAM_CHUNK_SIZE
 
 
     def compute(self):
         #
 
-        ps_ds = ogr.Open(self.ps_input_path)
-        output_proj_ds = ogr.GetDriverByName("ESRI Shapefile").CopyDataSource(ps_ds, self.ps_proj_path)
-
-        utils.addFieldManagement(output_proj_ds, "ALOS", ogr.OFTReal)
-        utils.addFieldManagement(output_proj_ds, "BLOS", ogr.OFTReal)
-        utils.addFieldManagement(output_proj_ds, "CLOS", ogr.OFTReal)
-        utils.addFieldManagement(output_proj_ds, "dip", ogr.OFTReal)
-        utils.addFieldManagement(output_proj_ds, "dipdir", ogr.OFTReal)
-
-        utils.calculateFieldManagement(output_proj_ds, "ALOS", self.exp_alos)
-        utils.calculateFieldManagement(output_proj_ds, "BLOS", self.exp_blos)
-        utils.calculateFieldManagement(output_proj_ds, "CLOS", self.exp_clos)
-        utils.calculateFieldManagement(output_proj_ds, "dip", self.exp_dip)
-        utils.calculateFieldManagement(output_proj_ds, "dipdir", self.exp_dipdir)
-
-        formula = "[VEL]*(1/(((cos(([dip]/57.29)))*(sin((([dipdir]-90)/57.29)))*[ALOS])+((-1)*(cos(([dip]/57.29)))*(cos((([dipdir]-90)/57.29)))*[BLOS])+((sin(([dip]/57.29)))*[CLOS])))"
-        utils.addFieldManagement(output_proj_ds, "VEL_PRJ", ogr.OFTReal)
-        utils.real_CalculateField_management(
-                output_proj_ds,
-                "VEL_PRJ",
-                formula,
-                ['VEL', 'ALOS', 'BLOS', 'CLOS', 'dip', 'dipdir'])
+        # the points of the extent only, through the spatial index
+        data_source, layer = utils.open_points(self.ps_input_path, self.extent)
+
+        # "[VEL]*(1/(((cos(([dip]/57.29)))*(sin((([dipdir]-90)/57.29)))*[ALOS])+((-1)*(cos(([dip]/57.29)))*(cos((([dipdir]-90)/57.29)))*[BLOS])+((sin(([dip]/57.29)))*[CLOS])))"
+        # dip and dipdir are constants, so is the projection factor
+        factor = kernels.projection_factor(numpy.float64(self.exp_dip), numpy.float64(self.exp_dipdir),
+                                           self.exp_alos, self.exp_blos, self.exp_clos)
+
+        # the new fields, the constants only if asked
+        fields = OrderedDict()
+        if self.constant_fields:
+            fields["ALOS"] = self.exp_alos
+            fields["BLOS"] = self.exp_blos
+            fields["CLOS"] = self.exp_clos
+            fields["dip"] = self.exp_dip
+            fields["dipdir"] = self.exp_dipdir
+        fields["VEL_PRJ"] = None
+
+        # the points are read sequentially a chunk at a time and appended
+        # to a new layer with the new fields: the memory is bounded by the
+        # chunk size
+        with utils.PointsWriter(layer, self.ps_proj_path, list(fields)) as writer:
+            for features, xs, ys, columns in utils.read_layer_chunks(layer, ['VEL'], self.chunk_size,
+                                                                     geometry=False):
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    fields["VEL_PRJ"] = columns['VEL'] / factor
+                writer.append(features, fields)
+        output_proj_ds = writer.output_ds
+        data_source = None
 
         self._save(output_proj_ds)
 
@@ -107,6 +125,7 @@ class PSProjectionToolAlg:
 class PSProjectionToolDDIRGeoAlg(GeoAlgorithm):
     """ was PS_projection_tools_DDIR.py """
 
+    EXTENT = "EXTENT"
     PS_INPUT = "PS_INPUT"       # Starting dataset: VEL
 
     EXP_ALOS = "EXP_ALOS"
@@ -115,6 +134,8 @@ class PSProjectionToolDDIRGeoAlg(GeoAlgorithm):
 
     EXP_DIP = "EXP_DIP"
     EXP_DIPDIR = "EXP_DIPDIR"
+    CONSTANT_FIELDS = "CONSTANT_FIELDS"
+    CHUNK_SIZE = "CHUNK_SIZE"
     
     PS_PROJ_PATH = "PS_PROJ_PATH"
 
@@ -124,6 +145,9 @@ class PSProjectionToolDDIRGeoAlg(GeoAlgorithm):
 
         self.addParameter(ParameterVector(PSProjectionToolDDIRGeoAlg.PS_INPUT,
                                           "Starting Dataset"))
+        self.addParameter(ParameterExtent(PSProjectionToolDDIRGeoAlg.EXTENT,
+                                          "Extent (empty: all the points)",
+                                          optional=True))
 
         self.addParameter(ParameterNumber(PSProjectionToolDDIRGeoAlg.EXP_ALOS,
                                           "Cosine Director in x",
@@ -151,6 +175,15 @@ class PSProjectionToolDDIRGeoAlg(GeoAlgorithm):
                                           minValue=0.0,
                                           maxValue=360.0,
                                           default=180.0))
+        self.addParameter(ParameterBoolean(PSProjectionToolDDIRGeoAlg.CONSTANT_FIELDS,
+                                           "Write the cosine directors, dip and dipdir as fields",
+                                           False))
+        chunk_size = ParameterNumber(PSProjectionToolDDIRGeoAlg.CHUNK_SIZE,
+                                     "Points read and written for chunk",
+                                     minValue=1,
+                                     default=utils.STREAM_CHUNK_SIZE)
+        chunk_size.isAdvanced = True
+        self.addParameter(chunk_size)
 
                                           
         self.addOutput(OutputVector(PSProjectionToolDDIRGeoAlg.PS_PROJ_PATH,
@@ -160,6 +193,8 @@ class PSProjectionToolDDIRGeoAlg(GeoAlgorithm):
         """ """
 
         ps_input_path = str(self.getParameterValue(PSProjectionToolDDIRGeoAlg.PS_INPUT))
+        extent = self.getParameterValue(PSProjectionToolDDIRGeoAlg.EXTENT)
+        extent = utils.convert_parameter(extent) if extent else None
 
         exp_alos = self.getParameterValue(PSProjectionToolDDIRGeoAlg.EXP_ALOS)
         exp_blos = self.getParameterValue(PSProjectionToolDDIRGeoAlg.EXP_BLOS)
@@ -167,6 +202,8 @@ class PSProjectionToolDDIRGeoAlg(GeoAlgorithm):
 
         exp_dip = self.getParameterValue(PSProjectionToolDDIRGeoAlg.EXP_DIP)
         exp_dipdir = self.getParameterValue(PSProjectionToolDDIRGeoAlg.EXP_DIPDIR)
+        constant_fields = self.getParameterValue(PSProjectionToolDDIRGeoAlg.CONSTANT_FIELDS)
+        chunk_size = self.getParameterValue(PSProjectionToolDDIRGeoAlg.CHUNK_SIZE)
         
         ps_proj_path = str(self.getOutputValue(PSProjectionToolDDIRGeoAlg.PS_PROJ_PATH))
 
@@ -177,5 +214,8 @@ class PSProjectionToolDDIRGeoAlg(GeoAlgorithm):
                 exp_clos,
                 exp_dip,
                 exp_dipdir,
-                ps_proj_path) as ps_proj_alg:
+                ps_proj_path,
+                constant_fields,
+                extent,
+                chunk_size) as ps_proj_alg:
             ps_proj_alg.compute()
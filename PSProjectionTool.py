@@ -24,10 +24,13 @@ __copyright__ = '(C) 2014, Riccardo Lemmi'
 __revision__ = '$Format:%H$'
 
 
+from collections import OrderedDict
+
 from osgeo import gdal, ogr
 import numpy
 
 import utils
+import kernels
 
 from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.outputs import OutputVector
@@ -36,6 +39,9 @@ from processing.core.outputs import OutputVector
 from processing.core.parameters import ParameterRaster
 from processing.core.parameters import ParameterVector
 from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterBoolean
+from processing.core.parameters import ParameterExtent
+from processing.core.parameters import ParameterSelection
 
 
 class PSProjectionToolAlg:
@@ -49,7 +55,13 @@ class PSProjectionToolAlg:
             exp_alos,
             exp_blos,
             exp_clos,
-            ps_proj_path):
+            ps_proj_path,
+            constant_fields=False,
+            dem_input_path=None,
+            extent=None,
+            backend='numpy',
+            min_factor=0.0,
+            chunk_size=None):
 
         self.ps_input_path = ps_input_path
 
@@ -61,37 +73,81 @@ class PSProjectionToolAlg:
         self.exp_clos = exp_clos
         
         self.ps_proj_path= ps_proj_path
+        self.constant_fields = constant_fields  # write ALOS, BLOS, CLOS
+        self.dem_input_path = dem_input_path    # slope and aspect computed from the DEM
+        self.extent = extent                    # None or only the points in xmin, ymin, xmax, ymax
+        self.backend = backend                  # one of kernels.KERNEL_BACKENDS
+        self.min_factor = min_factor            # VEL_PRJ null where |PRJ_FACT| < min_factor
+        self.chunk_size = chunk_size            # points for chunk, None for utils.STREAM_CHUNK_SIZE
 
         
     def compute(self):
         #
 
-        ps_ds = ogr.Open(self.ps_input_path)
-        output_proj_ds = ogr.GetDriverByName("ESRI Shapefile").CopyDataSource(ps_ds, self.ps_proj_path)
-
-        utils.addFieldManagement(output_proj_ds, "ALOS", ogr.OFTReal)
-        utils.addFieldManagement(output_proj_ds, "BLOS", ogr.OFTReal)
-        utils.addFieldManagement(output_proj_ds, "CLOS", ogr.OFTReal)
-
-        utils.calculateFieldManagement(output_proj_ds, "ALOS", self.exp_alos)
-        utils.calculateFieldManagement(output_proj_ds, "BLOS", self.exp_blos)
-        utils.calculateFieldManagement(output_proj_ds, "CLOS", self.exp_clos)
-
-        aspect_ds = gdal.Open(self.aspect_input_path, gdal.GA_ReadOnly)
-        utils.setFieldFromRasterPoints(aspect_ds, output_proj_ds, "ASPECT")
-
-        slope_ds = gdal.Open(self.slope_input_path, gdal.GA_ReadOnly)
-        utils.setFieldFromRasterPoints(slope_ds, output_proj_ds, "SLOPE")
-
-        formula = "[VEL]*(1/(((cos(([slope]/57.29)))*(sin((([aspect]-90)/57.29)))*[ALOS])+((-1)*(cos(([slope]/57.29)))*(cos((([aspect]-90)/57.29)))*[BLOS])+((sin(([slope]/57.29)))*[CLOS])))"
-        utils.addFieldManagement(output_proj_ds, "VEL_PRJ", ogr.OFTReal)
-        utils.real_CalculateField_management(
-                output_proj_ds,
-                "VEL_PRJ",
-                formula,
-                ['VEL', 'slope', 'aspect', 'ALOS', 'BLOS', 'CLOS'])
-        
-        self._save(output_proj_ds)
+        # the points of the extent only, through the spatial index
+        data_source, layer = utils.open_points(self.ps_input_path, self.extent)
+
+        # with a DEM only the tiles containing points are computed
+        slope_source, aspect_source = utils.slope_aspect_sources(
+                self.slope_input_path, self.aspect_input_path, self.dem_input_path)
+        aspect_ds = utils.open_raster(aspect_source)
+        slope_ds = utils.open_raster(slope_source)
+
+        self.factor_statistics = utils.ArrayStatistics(
+                *kernels.projection_factor_range(self.exp_alos, self.exp_blos, self.exp_clos))
+        self.masked_count = 0
+
+        # the new fields, the constants only if asked
+        names = ["ALOS", "BLOS", "CLOS"] if self.constant_fields else []
+        names += ["ASPECT", "SLOPE", "PRJ_FACT", "VEL_PRJ"]
+
+        # the points are read sequentially a chunk at a time and appended
+        # to a new layer with the new fields: the memory is bounded by the
+        # chunk size
+        try:
+            with utils.PointsWriter(layer, self.ps_proj_path, names) as writer:
+                for features, xs, ys, columns in utils.read_layer_chunks(layer, ['VEL'], self.chunk_size):
+                    fields = self._project(xs, ys, columns['VEL'], aspect_ds, slope_ds)
+                    writer.append(features, fields)
+        finally:
+            utils.close_raster(aspect_source)
+            utils.close_raster(slope_source)
+        data_source = None
+
+        # the statistics of the projection factor, read by the QA tools
+        # without scanning the points
+        metadata = self.factor_statistics.metadata("PRJ_FACT")
+        metadata["PRJ_FACT_THRESHOLD"] = repr(float(self.min_factor))
+        metadata["VEL_PRJ_MASKED_COUNT"] = str(self.masked_count)
+        utils.write_layer_metadata(writer.output_ds, self.ps_proj_path, metadata)
+
+        self._save(writer.output_ds)
+
+    def _project(self, xs, ys, vel, aspect_ds, slope_ds):
+        # the new fields of a chunk of points
+        aspect = utils.sample_raster_at_points(aspect_ds, xs, ys)
+        slope = utils.sample_raster_at_points(slope_ds, xs, ys)
+
+        # VEL_PRJ and its denominator (the projection factor) over the arrays
+        factor, vel_prj = kernels.projection(vel, slope, aspect,
+                                             self.exp_alos, self.exp_blos, self.exp_clos, self.backend)
+
+        # near zero the factor blows VEL_PRJ up: masked as null
+        masked = numpy.abs(factor) < self.min_factor
+        vel_prj[masked] = numpy.nan
+        self.masked_count += int(masked.sum())
+        self.factor_statistics.update(factor)
+
+        fields = OrderedDict()
+        if self.constant_fields:
+            fields["ALOS"] = self.exp_alos
+            fields["BLOS"] = self.exp_blos
+            fields["CLOS"] = self.exp_clos
+        fields["ASPECT"] = aspect
+        fields["SLOPE"] = slope
+        fields["PRJ_FACT"] = factor
+        fields["VEL_PRJ"] = vel_prj
+        return fields
 
         
     #     
@@ -109,14 +165,20 @@ class PSProjectionToolAlg:
 class PSProjectionToolGeoAlg(GeoAlgorithm):
     """ was PS_projection_tools.py """
 
+    EXTENT = "EXTENT"
     PS_INPUT = "PS_INPUT"       # Starting dataset: VEL -> SHP
 
     ASPECT_INPUT = "ASPECT_INPUT"     # Raster
     SLOPE_INPUT = "SLOPE_INPUT"       # Raster
+    DEM_INPUT = "DEM_INPUT"           # Raster, in place of aspect and slope
 
     EXP_ALOS = "EXP_ALOS"       
     EXP_BLOS = "EXP_BLOS"
     EXP_CLOS = "EXP_CLOS"
+    CONSTANT_FIELDS = "CONSTANT_FIELDS"
+    BACKEND = "BACKEND"
+    MIN_FACTOR = "MIN_FACTOR"
+    CHUNK_SIZE = "CHUNK_SIZE"
     
     PS_PROJ_PATH = "PS_PROJ_PATH"
 
@@ -126,12 +188,20 @@ class PSProjectionToolGeoAlg(GeoAlgorithm):
 
         self.addParameter(ParameterVector(PSProjectionToolGeoAlg.PS_INPUT,
                                           "Starting Dataset"))
+        self.addParameter(ParameterExtent(PSProjectionToolGeoAlg.EXTENT,
+                                          "Extent (empty: all the points)",
+                                          optional=True))
 
         self.addParameter(ParameterRaster(PSProjectionToolGeoAlg.ASPECT_INPUT,
-                                          "Aspect"))
+                                          "Aspect",
+                                          optional=True))
         self.addParameter(ParameterRaster(PSProjectionToolGeoAlg.SLOPE_INPUT,
-                                          "Slope"))
-                                          
+                                          "Slope",
+                                          optional=True))
+        self.addParameter(ParameterRaster(PSProjectionToolGeoAlg.DEM_INPUT,
+                                          "DEM (in place of Aspect and Slope)",
+                                          optional=True))
+
 
         self.addParameter(ParameterNumber(PSProjectionToolGeoAlg.EXP_ALOS,
                                           "Cosine Director in x",
@@ -148,6 +218,24 @@ class PSProjectionToolGeoAlg(GeoAlgorithm):
                                           minValue=0.0,
                                           maxValue=1.0,
                                           default=0.8))
+        self.addParameter(ParameterBoolean(PSProjectionToolGeoAlg.CONSTANT_FIELDS,
+                                           "Write the cosine directors as fields",
+                                           False))
+        self.addParameter(ParameterSelection(PSProjectionToolGeoAlg.BACKEND,
+                                             "Kernel backend (numpy if not installed)",
+                                             kernels.KERNEL_BACKENDS,
+                                             default=0))
+        self.addParameter(ParameterNumber(PSProjectionToolGeoAlg.MIN_FACTOR,
+                                          "Minimum projection factor, absolute value (0: no mask)",
+                                          minValue=0.0,
+                                          maxValue=1.0,
+                                          default=0.0))
+        chunk_size = ParameterNumber(PSProjectionToolGeoAlg.CHUNK_SIZE,
+                                     "Points read and written for chunk",
+                                     minValue=1,
+                                     default=utils.STREAM_CHUNK_SIZE)
+        chunk_size.isAdvanced = True
+        self.addParameter(chunk_size)
 
         self.addOutput(OutputVector(PSProjectionToolGeoAlg.PS_PROJ_PATH,
                                     "Speed Projection respect aspect and slope"))
@@ -156,13 +244,23 @@ class PSProjectionToolGeoAlg(GeoAlgorithm):
         """ """
         
         ps_input_path = str(self.getParameterValue(PSProjectionToolGeoAlg.PS_INPUT))
+        extent = self.getParameterValue(PSProjectionToolGeoAlg.EXTENT)
+        extent = utils.convert_parameter(extent) if extent else None
         
-        aspect_input_path = str(self.getParameterValue(PSProjectionToolGeoAlg.ASPECT_INPUT))
-        slope_input_path = str(self.getParameterValue(PSProjectionToolGeoAlg.SLOPE_INPUT))
+        aspect_input_path = self.getParameterValue(PSProjectionToolGeoAlg.ASPECT_INPUT)
+        aspect_input_path = str(aspect_input_path) if aspect_input_path else None
+        slope_input_path = self.getParameterValue(PSProjectionToolGeoAlg.SLOPE_INPUT)
+        slope_input_path = str(slope_input_path) if slope_input_path else None
+        dem_input_path = self.getParameterValue(PSProjectionToolGeoAlg.DEM_INPUT)
+        dem_input_path = str(dem_input_path) if dem_input_path else None
 
         exp_alos = self.getParameterValue(PSProjectionToolGeoAlg.EXP_ALOS)
         exp_blos = self.getParameterValue(PSProjectionToolGeoAlg.EXP_BLOS)
         exp_clos = self.getParameterValue(PSProjectionToolGeoAlg.EXP_CLOS)
+        constant_fields = self.getParameterValue(PSProjectionToolGeoAlg.CONSTANT_FIELDS)
+        backend = kernels.KERNEL_BACKENDS[self.getParameterValue(PSProjectionToolGeoAlg.BACKEND)]
+        min_factor = self.getParameterValue(PSProjectionToolGeoAlg.MIN_FACTOR)
+        chunk_size = self.getParameterValue(PSProjectionToolGeoAlg.CHUNK_SIZE)
 
         ps_proj_path = str(self.getOutputValue(PSProjectionToolGeoAlg.PS_PROJ_PATH))
 
@@ -173,5 +271,11 @@ class PSProjectionToolGeoAlg(GeoAlgorithm):
                 exp_alos,
                 exp_blos,
                 exp_clos,
-                ps_proj_path) as ps_proj_alg:
+                ps_proj_path,
+                constant_fields,
+                dem_input_path,
+                extent,
+                backend,
+                min_factor,
+                chunk_size) as ps_proj_alg:
             ps_proj_alg.compute()
@@ -28,6 +28,7 @@ from osgeo import gdal
 import numpy
 
 import utils
+import kernels
 
 from processing.core.GeoAlgorithm import GeoAlgorithm
 from processing.core.outputs import OutputRaster
@@ -35,6 +36,13 @@ from processing.core.outputs import OutputRaster
 from processing.core.parameters import ParameterRaster
 from processing.core.parameters import ParameterNumber
 from processing.core.parameters import ParameterExtent
+from processing.core.parameters import ParameterSelection
+
+
+def compute_r_index(slope_array, aspect_array, west_angle, incidence_angle, backend='numpy'):
+    # "(Sin (([slope] * (Sin (([aspect] + [WA]) div 57.925)) - [IA]) div 57.295)) * -1"
+    # backend: one of kernels.KERNEL_BACKENDS
+    return kernels.r_index(slope_array, aspect_array, west_angle, incidence_angle, backend)
 
 
 class PSRIndexAlg:
@@ -48,7 +56,13 @@ class PSRIndexAlg:
             west_angle,
             incidence_angle,
             cell_size,
-            r_index_path):
+            r_index_path,
+            tile_size=None,
+            workers=1,
+            backend='numpy',
+            dem_input_path=None,
+            output_profile='deflate',
+            scratch_dir=None):
 
         self.extent = extent
 
@@ -59,41 +73,62 @@ class PSRIndexAlg:
         self.cell_size = cell_size
 
         self.r_index_path = r_index_path
+        self.tile_size = tile_size    # None: output blocks with overviews, or native
+                                      # block of the slope grid
+        self.workers = workers        # 0: all the cores
+        self.backend = backend        # one of kernels.KERNEL_BACKENDS
+        self.dem_input_path = dem_input_path  # slope and aspect computed from the DEM
+        self.output_profile = output_profile  # one of utils.OUTPUT_PROFILE_NAMES
+        self.scratch_dir = scratch_dir        # see utils.create_output
+        self.dst = None                       # the output, see utils.create_output
+        self.bandOut = None
 
         #
-        self.aspect = gdal.Open(str(self.aspect_input_path))
-        self.slope = gdal.Open(str(self.slope_input_path))
+        self.slope_source, self.aspect_source = utils.slope_aspect_sources(
+                self.slope_input_path, self.aspect_input_path, self.dem_input_path)
+        self.aspect = utils.open_raster(self.aspect_source)
+        self.slope = utils.open_raster(self.slope_source)
 
     def compute(self):
         #
         self.cols, self.rows = utils.extent_size(self.extent, self.cell_size)  
 
-        slope_array = self.slope.GetRasterBand(1).ReadAsArray(0, 0, self.cols, self.rows) 
-        aspect_array = self.slope.GetRasterBand(1).ReadAsArray(0, 0, self.cols, self.rows)
+        self._create()
 
-        west_angle_array = self.west_angle * numpy.ones((self.rows, self.cols), dtype=numpy.byte)
-        incidence_angle_array = self.incidence_angle * numpy.ones((self.rows, self.cols), dtype=numpy.byte)
+        # the output is computed tile by tile: the memory is bounded by the tile size
+        # (the output blocks, aligned on the overviews, if the tile size is not given)
+        tile_size = self.tile_size or utils.output_tile_size(self.output_profile)
+        tile_width, tile_height = utils.tile_shape(self.slope.GetRasterBand(1), tile_size)
+        windows = utils.raster_windows(self.cols, self.rows, tile_width, tile_height)
 
-        # "(Sin (([slope] * (Sin (([aspect] + [WA]) div 57.925)) - [IA]) div 57.295)) * -1"
-        r_index_array = - numpy.sin(slope_array * (numpy.sin((aspect_array + west_angle_array) / 57.925) - incidence_angle_array) / 57.295)
-        
-        self._save(r_index_array)
+        # the tiles are computed by the workers and written here
+        input_paths = [self.slope_source, self.aspect_source]
+        for (xoff, yoff, width, height), r_index_array in utils.map_tiles(
+                compute_r_index,
+                input_paths,
+                windows,
+                (self.west_angle, self.incidence_angle, self.backend),
+                self.workers):
+            utils.write_output(self.dst, r_index_array, xoff, yoff)
 
+        self.bandOut.FlushCache()
+        utils.finish_output(self.dst, self.output_profile)
 
-    def _save(self, array):
+    def _create(self):
         # create the output image
-        driver = gdal.GetDriverByName('GTiff')
-        dst = driver.Create(
+        self.dst = utils.create_output(
               self.r_index_path,
               self.cols,
               self.rows,
               1,                        # number of bands
-              gdal.GDT_Float32)         # data type
+              gdal.GDT_Float32,         # data type
+              self.output_profile,
+              scratch_dir=self.scratch_dir)
 
         new_ulx, new_uly, new_lrx, new_lry = self.extent
-        dst.SetGeoTransform([new_ulx, self.cell_size, 0, new_uly, 0, self.cell_size])
+        self.dst.SetGeoTransform([new_ulx, self.cell_size, 0, new_uly, 0, self.cell_size])
 
-        self.bandOut = dst.GetRasterBand(1)
+        self.bandOut = self.dst.GetRasterBand(1)
         self.bandOut.SetNoDataValue(-3.4e+38)
         #bandOut.SetStatistics(
         #          self.min,
@@ -101,14 +136,17 @@ class PSRIndexAlg:
         #          numpy.mean([self.max, self.min]),
         #          self.std)
 
-        self.bandOut.WriteArray(array)
-        self.bandOut.FlushCache()
-
     def __enter__(self):
         return  self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        # the output is ended on error too
+        intermediate_path = utils.discard_output(self.dst)
+        self.bandOut = None
+        self.dst = None     # close the file
+        utils.close_output(intermediate_path)
+        for source in (self.aspect_source, self.slope_source):
+            utils.close_raster(source)
 
 
 class PSRIndexGeoAlg(GeoAlgorithm):
@@ -118,10 +156,14 @@ class PSRIndexGeoAlg(GeoAlgorithm):
 
     ASPECT_INPUT = "ASPECT_INPUT"       # raster
     SLOPE_INPUT = "SLOPE_INPUT"         # raster
+    DEM_INPUT = "DEM_INPUT"             # raster, in place of aspect and slope
 
     WEST_ANGLE = "WEST_ANGLE"
     INCIDENCE_ANGLE = "INCIDENCE_ANGLE"
     CELL_SIZE = "CELL_SIZE"
+    TILE_SIZE = "TILE_SIZE"
+    WORKERS = "WORKERS"
+    BACKEND = "BACKEND"
 
     R_INDEX_OUTPUT = "R_INDEX_OUTPUT"          # raster
 
@@ -134,9 +176,14 @@ class PSRIndexGeoAlg(GeoAlgorithm):
                                           "Extent"))
 
         self.addParameter(ParameterRaster(PSRIndexGeoAlg.ASPECT_INPUT,
-                                          "Aspect Grid"))
+                                          "Aspect Grid",
+                                          optional=True))
         self.addParameter(ParameterRaster(PSRIndexGeoAlg.SLOPE_INPUT,
-                                          "Slope Grid"))
+                                          "Slope Grid",
+                                          optional=True))
+        self.addParameter(ParameterRaster(PSRIndexGeoAlg.DEM_INPUT,
+                                          "DEM (in place of the Aspect and Slope Grids)",
+                                          optional=True))
 
         self.addParameter(ParameterNumber(PSRIndexGeoAlg.WEST_ANGLE,
                                           "West Angle",
@@ -152,6 +199,19 @@ class PSRIndexGeoAlg(GeoAlgorithm):
                                           "Cell Size",
                                           minValue=1,
                                           default=25))
+        self.addParameter(ParameterNumber(PSRIndexGeoAlg.TILE_SIZE,
+                                          "Tile Size (0: output or native blocks)",
+                                          minValue=0,
+                                          default=0))
+        self.addParameter(ParameterNumber(PSRIndexGeoAlg.WORKERS,
+                                          "Number of Workers (0: all the cores)",
+                                          minValue=0,
+                                          default=1))
+        self.addParameter(ParameterSelection(PSRIndexGeoAlg.BACKEND,
+                                             "Kernel backend (numpy if not installed)",
+                                             kernels.KERNEL_BACKENDS,
+                                             default=0))
+        utils.add_output_parameters(self)   # advanced
 
 
         self.addOutput(OutputRaster(PSRIndexGeoAlg.R_INDEX_OUTPUT,
@@ -160,21 +220,35 @@ class PSRIndexGeoAlg(GeoAlgorithm):
     def processAlgorithm(self, progress):
         extent = utils.convert_parameter(self.getParameterValue(PSRIndexGeoAlg.EXTENT))
 
-        aspect_input_path = str(self.getParameterValue(PSRIndexGeoAlg.ASPECT_INPUT))
-        slope_input_path = str(self.getParameterValue(PSRIndexGeoAlg.SLOPE_INPUT))
+        aspect_input_path = self.getParameterValue(PSRIndexGeoAlg.ASPECT_INPUT)
+        aspect_input_path = str(aspect_input_path) if aspect_input_path else None
+        slope_input_path = self.getParameterValue(PSRIndexGeoAlg.SLOPE_INPUT)
+        slope_input_path = str(slope_input_path) if slope_input_path else None
+        dem_input_path = self.getParameterValue(PSRIndexGeoAlg.DEM_INPUT)
+        dem_input_path = str(dem_input_path) if dem_input_path else None
 
         west_angle = self.getParameterValue(PSRIndexGeoAlg.WEST_ANGLE)
         incidence_angle = self.getParameterValue(PSRIndexGeoAlg.INCIDENCE_ANGLE)
         cell_size = self.getParameterValue(PSRIndexGeoAlg.CELL_SIZE)
+        tile_size = self.getParameterValue(PSRIndexGeoAlg.TILE_SIZE)
+        workers = self.getParameterValue(PSRIndexGeoAlg.WORKERS)
+        backend = kernels.KERNEL_BACKENDS[self.getParameterValue(PSRIndexGeoAlg.BACKEND)]
+        output_profile, block_cache, scratch_dir = utils.output_parameters(self)
 
         r_index_path = str(self.getOutputValue(PSRIndexGeoAlg.R_INDEX_OUTPUT))
 
-        with PSRIndexAlg(
+        with utils.BlockCache(block_cache), PSRIndexAlg(
                 extent,
                 aspect_input_path,
                 slope_input_path,
                 west_angle,
                 incidence_angle,
                 cell_size,
-                r_index_path) as rindex:
+                r_index_path,
+                tile_size,
+                workers,
+                backend,
+                dem_input_path,
+                output_profile,
+                scratch_dir) as rindex:
             rindex.compute()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+    PSSpeedBatch.py
+    ---------------------
+    Date                 : October 2026
+    Copyright            : (C) 2026 by Riccardo Lemmi
+    Email                : riccardo at reflab dot com
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+__author__ = 'Riccardo Lemmi'
+__date__ = 'October 2026'
+__copyright__ = '(C) 2026, Riccardo Lemmi'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+
+import os
+import csv
+
+import utils
+from PSHSpeed import PSHSpeedAlg
+from PSEWSpeed import PSEWSpeedAlg
+from PSSpeedDecomposition import PSSpeedDecompositionAlg
+
+from processing.core.GeoAlgorithm import GeoAlgorithm
+from processing.core.outputs import OutputDirectory
+
+from processing.core.parameters import ParameterFile
+from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterString
+from processing.core.parameters import ParameterSelection
+from processing.core.parameters import ParameterBoolean
+
+
+# speed models: the 'model' column of the manifest
+SPEED_MODELS = {
+    'h': PSHSpeedAlg,       # horizontal
+    'ew': PSEWSpeedAlg,     # east-west
+    'ewh': PSSpeedDecompositionAlg,   # both, a band each
+}
+
+# columns of the manifest, 'name' and 'model' are optional
+MANIFEST_COLUMNS = ['name', 'model', 'asc', 'desc',
+                    'cd_e_asc', 'cd_h_asc', 'cd_e_desc', 'cd_h_desc',
+                    'xmin', 'ymin', 'xmax', 'ymax']
+
+
+def read_manifest(manifest_path):
+    # read the asc/desc pairs of a CSV manifest (see MANIFEST_COLUMNS),
+    # return a list of dictionaries
+    pairs = []
+    with open(manifest_path, 'rb') as manifest:
+        for i, row in enumerate(csv.DictReader(manifest)):
+            row = dict((k.strip().lower(), v.strip()) for k, v in row.items() if k)
+            missing = [c for c in MANIFEST_COLUMNS[2:] if not row.get(c)]
+            if missing:
+                raise Exception("Manifest row %d: missing %s" % (i + 1, ', '.join(missing)))
+
+            model = row.get('model') or 'h'
+            if model not in SPEED_MODELS:
+                raise Exception("Manifest row %d: unknown model %s" % (i + 1, model))
+
+            pairs.append({
+                'name': row.get('name') or 'pair_%d' % (i + 1),
+                'model': model,
+                'asc': row['asc'],
+                'desc': row['desc'],
+                'cd_e_asc': utils.cosine_director(row['cd_e_asc']),
+                'cd_h_asc': utils.cosine_director(row['cd_h_asc']),
+                'cd_e_desc': utils.cosine_director(row['cd_e_desc']),
+                'cd_h_desc': utils.cosine_director(row['cd_h_desc']),
+                'extent': [float(row[c]) for c in ('xmin', 'ymin', 'xmax', 'ymax')],
+            })
+    return pairs
+
+
+class PSSpeedBatchAlg:
+    # Computation of the speed models for many asc/desc pairs
+
+    def __init__(
+            self,
+            manifest_path,
+            point_size,
+            output_dir,
+            vel_field='VEL',
+            aggregation='mean',
+            workers=1,
+            grid_cache=False,
+            output_profile='deflate',
+            scratch_dir=None):
+
+        self.manifest_path = manifest_path
+        self.point_size = point_size
+        self.output_dir = output_dir
+
+        self.vel_field = vel_field
+        self.aggregation = aggregation    # one of utils.GRID_AGGREGATIONS
+        self.workers = workers            # 0: all the cores
+        self.grid_cache = grid_cache      # keep the grids in utils.GRID_CACHE_DIR
+        self.output_profile = output_profile  # one of utils.OUTPUT_PROFILE_NAMES
+        self.scratch_dir = scratch_dir        # see utils.create_output
+
+        self.output_paths = []
+
+    def compute(self):
+        #
+        pairs = read_manifest(self.manifest_path)
+
+        # every input is gridded once for each extent, on the workers; a
+        # pair is computed as soon as its grids are ready and a grid is
+        # dropped after the last pair using it
+        pair_keys = []
+        keys = []
+        for pair in pairs:
+            pair_keys.append([utils.grid_key(input_path, self.vel_field, pair['extent'],
+                                             self.point_size, self.aggregation)
+                              for input_path in (pair['asc'], pair['desc'])])
+            for key in pair_keys[-1]:
+                if key not in keys:
+                    keys.append(key)
+
+        # one output for each pair
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        grids = {}
+        done = 0
+        for key, grid in utils.iter_grid_point_files(keys, self.workers, self.grid_cache):
+            grids[key] = grid
+            while done < len(pairs) and all(k in grids for k in pair_keys[done]):
+                self._compute_pair(pairs[done], grids)
+                done += 1
+                needed = set(k for ks in pair_keys[done:] for k in ks)
+                for k in list(grids):
+                    if k not in needed:
+                        del grids[k]
+
+    def _compute_pair(self, pair, grids):
+        # the speed model of a pair on the grids of its inputs
+        output_path = os.path.join(self.output_dir, '%s.tif' % pair['name'])
+        with SPEED_MODELS[pair['model']](
+                pair['asc'],
+                pair['desc'],
+                pair['extent'],
+                self.point_size,
+                pair['cd_e_asc'],
+                pair['cd_h_asc'],
+                pair['cd_e_desc'],
+                pair['cd_h_desc'],
+                output_path,
+                self.vel_field,
+                self.aggregation,
+                grids,
+                output_profile=self.output_profile,
+                scratch_dir=self.scratch_dir) as vel:
+            vel.compute()
+            self.output_paths.append(output_path)
+
+    def __enter__(self):
+        return  self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class PSSpeedBatchGeoAlg(GeoAlgorithm):
+    """ batch of PSHSpeedGeoAlg/PSEWSpeedGeoAlg """
+
+    MANIFEST = "MANIFEST"                 # CSV
+
+    POINT_SIZE = "POINT_SIZE"
+    VEL_FIELD = "VEL_FIELD"
+    AGGREGATION = "AGGREGATION"
+    WORKERS = "WORKERS"
+    GRID_CACHE = "GRID_CACHE"
+
+    OUTPUT_DIR = "OUTPUT_DIR"             # one raster for each pair
+
+    def defineCharacteristics(self):
+        self.name = "Model to compute speed components for many pairs of PS points"
+        self.group = "[pstools]"
+
+        self.addParameter(ParameterFile(PSSpeedBatchGeoAlg.MANIFEST,
+                                        "Manifest of the asc/desc pairs (CSV: %s)" % ', '.join(MANIFEST_COLUMNS),
+                                        optional=False,
+                                        ext='csv'))
+
+        self.addParameter(ParameterNumber(PSSpeedBatchGeoAlg.POINT_SIZE,
+                                          "Point Size",
+                                          minValue=1,
+                                          default=25))
+        self.addParameter(ParameterString(PSSpeedBatchGeoAlg.VEL_FIELD,
+                                          "Velocity Field",
+                                          default="VEL"))
+        self.addParameter(ParameterSelection(PSSpeedBatchGeoAlg.AGGREGATION,
+                                             "Aggregation of the points in a cell",
+                                             utils.GRID_AGGREGATIONS,
+                                             default=0))
+        self.addParameter(ParameterNumber(PSSpeedBatchGeoAlg.WORKERS,
+                                          "Number of Workers (0: all the cores)",
+                                          minValue=0,
+                                          default=1))
+        self.addParameter(ParameterBoolean(PSSpeedBatchGeoAlg.GRID_CACHE,
+                                           "Keep the gridded points in the cache",
+                                           False))
+        utils.add_output_parameters(self)   # advanced
+
+        self.addOutput(OutputDirectory(PSSpeedBatchGeoAlg.OUTPUT_DIR,
+                                       "Speed Images folder"))
+
+    def processAlgorithm(self, progress):
+        manifest_path = str(self.getParameterValue(PSSpeedBatchGeoAlg.MANIFEST))
+        point_size = self.getParameterValue(PSSpeedBatchGeoAlg.POINT_SIZE)
+        vel_field = str(self.getParameterValue(PSSpeedBatchGeoAlg.VEL_FIELD))
+        aggregation = utils.GRID_AGGREGATIONS[self.getParameterValue(PSSpeedBatchGeoAlg.AGGREGATION)]
+        workers = self.getParameterValue(PSSpeedBatchGeoAlg.WORKERS)
+        grid_cache = self.getParameterValue(PSSpeedBatchGeoAlg.GRID_CACHE)
+        output_profile, block_cache, scratch_dir = utils.output_parameters(self)
+
+        output_dir = str(self.getOutputValue(PSSpeedBatchGeoAlg.OUTPUT_DIR))
+
+        with utils.BlockCache(block_cache), PSSpeedBatchAlg(
+                manifest_path,
+                point_size,
+                output_dir,
+                vel_field,
+                aggregation,
+                workers,
+                grid_cache,
+                output_profile,
+                scratch_dir) as batch:
+            batch.compute()
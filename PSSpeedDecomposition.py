@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+    PSSpeedDecomposition.py
+    ---------------------
+    Date                 : October 2026
+    Copyright            : (C) 2026 by Riccardo Lemmi
+    Email                : riccardo at reflab dot com
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+"""
+
+__author__ = 'Riccardo Lemmi'
+__date__ = 'October 2026'
+__copyright__ = '(C) 2026, Riccardo Lemmi'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+
+
+from osgeo import gdal
+import numpy
+
+import utils
+
+from processing.core.GeoAlgorithm import GeoAlgorithm
+from processing.core.outputs import OutputRaster
+
+from processing.core.parameters import ParameterVector
+from processing.core.parameters import ParameterRaster
+from processing.core.parameters import ParameterNumber
+from processing.core.parameters import ParameterExtent
+from processing.core.parameters import ParameterString
+from processing.core.parameters import ParameterSelection
+from processing.core.parameters import ParameterBoolean
+
+
+# bands of the output image
+DECOMPOSITION_BANDS = ['East-West', 'Horizontal']
+
+
+def decompose_speed(asc_array, desc_array, cd_e_asc, cd_h_asc, cd_e_desc, cd_h_desc, extent, cell_size):
+    # the East-West and horizontal speed of PSEWSpeedAlg and PSHSpeedAlg
+    # in one pass over the grids (see utils.solve_speeds), return (EW, H)
+    # float32 arrays
+    cosine_directors = (cd_e_asc, cd_h_asc, cd_e_desc, cd_h_desc)
+    return tuple(utils.solve_speeds(asc_array, desc_array, cosine_directors, extent, cell_size, (0, 1)))
+
+
+class PSSpeedDecompositionAlg:
+    # Computation of the East-West and horizontal speed in a single pass
+
+    def __init__(
+            self,
+            asc_input_path,
+            desc_input_path,
+            extent,
+            point_size,
+            cd_e_asc,                     # number or raster path (see utils.cosine_director)
+            cd_h_asc,
+            cd_e_desc,
+            cd_h_desc,
+            output_path,
+            vel_field='VEL',
+            aggregation='mean',
+            grids=None,
+            grid_cache=False,
+            output_profile='deflate',
+            scratch_dir=None):
+
+        self.asc_input_path = asc_input_path
+        self.desc_input_path = desc_input_path
+
+        self.extent = extent
+        self.point_size = point_size
+
+        self.cd_e_asc = cd_e_asc
+        self.cd_h_asc = cd_h_asc
+        self.cd_e_desc = cd_e_desc
+        self.cd_h_desc = cd_h_desc
+
+        self.output_path = output_path
+
+        self.vel_field = vel_field
+        self.aggregation = aggregation    # one of utils.GRID_AGGREGATIONS
+        self.grids = grids                # None or dictionary utils.grid_key:array
+                                          # of grids shared between runs
+        self.grid_cache = grid_cache      # keep the grids in utils.GRID_CACHE_DIR
+        self.output_profile = output_profile  # one of utils.OUTPUT_PROFILE_NAMES
+        self.scratch_dir = scratch_dir        # see utils.create_output
+
+    def _save(self, arrays):
+        # create the output image, a band for each of DECOMPOSITION_BANDS
+        dst = utils.create_output(
+              self.output_path,
+              self.cols,
+              self.rows,
+              len(arrays),              # number of bands
+              gdal.GDT_Float32,         # data type
+              self.output_profile,
+              scratch_dir=self.scratch_dir)
+
+        try:
+            xmin, ymin, xmax, ymax = self.extent        # north up, as utils.grid_points
+            dst.SetGeoTransform([xmin, self.point_size, 0, ymax, 0, -self.point_size])
+
+            for i, array in enumerate(arrays):
+                bandOut = dst.GetRasterBand(i + 1)
+                bandOut.SetDescription(DECOMPOSITION_BANDS[i])
+                bandOut.SetNoDataValue(-3.4e+38)
+                array[numpy.isnan(array)] = -3.4e+38     # empty cells
+                utils.write_output(dst, array, band=i + 1)
+                bandOut.FlushCache()
+
+            utils.finish_output(dst, self.output_profile)
+        finally:
+            # the output is ended on error too
+            intermediate_path = utils.discard_output(dst)
+            bandOut = None
+            dst = None                      # close the file
+            utils.close_output(intermediate_path)
+
+    def compute(self):
+        #
+
+        # the inputs are gridded once for both the components
+        gridded_asc_array = utils.shared_grid_point_file(
+                self.asc_input_path, self.vel_field, self.extent, self.point_size,
+                self.aggregation, self.grids, self.grid_cache)
+        gridded_desc_array = utils.shared_grid_point_file(
+                self.desc_input_path, self.vel_field, self.extent, self.point_size,
+                self.aggregation, self.grids, self.grid_cache)
+        self.rows, self.cols = gridded_asc_array.shape
+
+        speed_arrays = decompose_speed(
+                gridded_asc_array,
+                gridded_desc_array,
+                self.cd_e_asc,
+                self.cd_h_asc,
+                self.cd_e_desc,
+                self.cd_h_desc,
+                self.extent,
+                self.point_size)
+
+        self._save(speed_arrays)
+
+    def __enter__(self):
+        return  self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class PSSpeedDecompositionGeoAlg(GeoAlgorithm):
+    """ PS_VelEo.py and PS_Velh.py in a single pass """
+
+    ASC_INPUT = "ASC_INPUT"                 # Ascending -> SHP
+    DESC_INPUT = "DISC_INPUT"               # Descending -> SHP
+
+    EXTENT = "EXTENT"
+    POINT_SIZE = "POINT_SIZE"
+    VEL_FIELD = "VEL_FIELD"
+    AGGREGATION = "AGGREGATION"
+    GRID_CACHE = "GRID_CACHE"
+
+    COSENO_DIRETTORE_E_ASCENDENTE = "CD_E_ASC"
+    COSENO_DIRETTORE_H_ASCENDENTE = "CD_H_ASC"
+    COSENO_DIRETTORE_E_DISCENDENTE = "CD_E_DISC"  # Cosine Director East Descending
+    COSENO_DIRETTORE_H_DISCENDENTE = "CD_H_DISC"
+    COSENO_DIRETTORE_E_ASCENDENTE_RASTER = "CD_E_ASC_RASTER"
+    COSENO_DIRETTORE_H_ASCENDENTE_RASTER = "CD_H_ASC_RASTER"
+    COSENO_DIRETTORE_E_DISCENDENTE_RASTER = "CD_E_DISC_RASTER"
+    COSENO_DIRETTORE_H_DISCENDENTE_RASTER = "CD_H_DISC_RASTER"
+
+    OUTPUT_PATH = "OUTPUT_PATH"           # Raster, a band for each component
+
+    def defineCharacteristics(self):
+        self.name = "Model to compute East-West and Horizontal components of speed for PS points"
+        self.group = "[pstools]"
+
+        self.addParameter(ParameterVector(PSSpeedDecompositionGeoAlg.ASC_INPUT,
+                                          "Ascending Vector"))
+        self.addParameter(ParameterVector(PSSpeedDecompositionGeoAlg.DESC_INPUT,
+                                          "Descending Vector"))
+
+        self.addParameter(ParameterExtent(PSSpeedDecompositionGeoAlg.EXTENT,
+                                             "Extent"))
+        self.addParameter(ParameterNumber(PSSpeedDecompositionGeoAlg.POINT_SIZE,
+                                          "Point Size",
+                                          minValue=1,
+                                          default=25))
+        self.addParameter(ParameterString(PSSpeedDecompositionGeoAlg.VEL_FIELD,
+                                          "Velocity Field",
+                                          default="VEL"))
+        self.addParameter(ParameterSelection(PSSpeedDecompositionGeoAlg.AGGREGATION,
+                                             "Aggregation of the points in a cell",
+                                             utils.GRID_AGGREGATIONS,
+                                             default=0))
+        self.addParameter(ParameterBoolean(PSSpeedDecompositionGeoAlg.GRID_CACHE,
+                                           "Keep the gridded points in the cache",
+                                           False))
+        utils.add_output_parameters(self)   # advanced
+
+        self.addParameter(ParameterNumber(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE,
+                                          "Cosine Director East Ascending",
+                                          minValue=0.0,
+                                          maxValue=1.0,
+                                          default=0.6))
+        self.addParameter(ParameterNumber(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_H_ASCENDENTE,
+                                          "Cosine Director Horizontal Ascending",
+                                          minValue=0.0,
+                                          maxValue=1.0,
+                                          default=0.5))
+        self.addParameter(ParameterNumber(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_E_DISCENDENTE,
+                                          "Cosine Director East Descending",
+                                          minValue=0.0,
+                                          maxValue=1.0,
+                                          default=0.8))
+        self.addParameter(ParameterNumber(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_H_DISCENDENTE,
+                                          "Cosine Director Horizontal Descending",
+                                          minValue=0.0,
+                                          maxValue=1.0,
+                                          default=0.5))
+        self.addParameter(ParameterRaster(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE_RASTER,
+                                          "Cosine Director East Ascending Raster (in place of the number)",
+                                          optional=True))
+        self.addParameter(ParameterRaster(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_H_ASCENDENTE_RASTER,
+                                          "Cosine Director Horizontal Ascending Raster (in place of the number)",
+                                          optional=True))
+        self.addParameter(ParameterRaster(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_E_DISCENDENTE_RASTER,
+                                          "Cosine Director East Descending Raster (in place of the number)",
+                                          optional=True))
+        self.addParameter(ParameterRaster(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_H_DISCENDENTE_RASTER,
+                                          "Cosine Director Horizontal Descending Raster (in place of the number)",
+                                          optional=True))
+
+        self.addOutput(OutputRaster(PSSpeedDecompositionGeoAlg.OUTPUT_PATH,
+                                    "East-West and Horizontal Speed Image"))
+
+    def processAlgorithm(self, progress):
+        asc_input_path = str(self.getParameterValue(PSSpeedDecompositionGeoAlg.ASC_INPUT))
+        desc_input_path = str(self.getParameterValue(PSSpeedDecompositionGeoAlg.DESC_INPUT))
+        extent = utils.convert_parameter(self.getParameterValue(PSSpeedDecompositionGeoAlg.EXTENT))
+        point_size = self.getParameterValue(PSSpeedDecompositionGeoAlg.POINT_SIZE)
+        vel_field = str(self.getParameterValue(PSSpeedDecompositionGeoAlg.VEL_FIELD))
+        aggregation = utils.GRID_AGGREGATIONS[self.getParameterValue(PSSpeedDecompositionGeoAlg.AGGREGATION)]
+        grid_cache = self.getParameterValue(PSSpeedDecompositionGeoAlg.GRID_CACHE)
+        output_profile, block_cache, scratch_dir = utils.output_parameters(self)
+        cd_e_asc = (self.getParameterValue(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE_RASTER) or
+                    self.getParameterValue(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_E_ASCENDENTE))
+        cd_h_asc = (self.getParameterValue(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_H_ASCENDENTE_RASTER) or
+                    self.getParameterValue(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_H_ASCENDENTE))
+        cd_e_desc = (self.getParameterValue(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_E_DISCENDENTE_RASTER) or
+                     self.getParameterValue(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_E_DISCENDENTE))
+        cd_h_desc = (self.getParameterValue(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_H_DISCENDENTE_RASTER) or
+                     self.getParameterValue(PSSpeedDecompositionGeoAlg.COSENO_DIRETTORE_H_DISCENDENTE))
+
+        output_path = str(self.getOutputValue(PSSpeedDecompositionGeoAlg.OUTPUT_PATH))
+
+        with utils.BlockCache(block_cache), PSSpeedDecompositionAlg(
+                asc_input_path,
+                desc_input_path,
+                extent,
+                point_size,
+                cd_e_asc,
+                cd_h_asc,
+                cd_e_desc,
+                cd_h_desc,
+                output_path,
+                vel_field,
+                aggregation,
+                None,
+                grid_cache,
+                output_profile,
+                scratch_dir) as vel:
+            vel.compute()
@@ -34,6 +34,9 @@ from PSCRIndex import PSCRIndexGeoAlg
 from PSRIndex import PSRIndexGeoAlg
 from PSProjectionTool import PSProjectionToolGeoAlg
 from PSProjectionDDIRTool import PSProjectionToolDDIRGeoAlg
+from PSSpeedBatch import PSSpeedBatchGeoAlg
+from PSSpeedDecomposition import PSSpeedDecompositionGeoAlg
+from PSLOSDecomposition import PSLOSDecompositionGeoAlg
 
 
 class PSToolsAlgorithmProvider(AlgorithmProvider):
@@ -47,6 +50,9 @@ class PSToolsAlgorithmProvider(AlgorithmProvider):
             PSRIndexGeoAlg(),
             PSProjectionToolGeoAlg(),
             PSProjectionToolDDIRGeoAlg(),
+            PSSpeedBatchGeoAlg(),
+            PSSpeedDecompositionGeoAlg(),
+            PSLOSDecompositionGeoAlg(),
         ]
 
     def initializeSettings(self):
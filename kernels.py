@@ -0,0 +1,196 @@
+# kernels
+# The R Index, CR Index and speed projection formulas for each backend:
+# the numpy one is the reference, numexpr and numba (when installed) evaluate the whole
+# formula in a single multi-threaded loop, without temporaries.
+
+import math
+import numpy
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+KERNEL_BACKENDS = ['numpy', 'numexpr', 'numba']
+
+
+def available_backends():
+    # the backends installed
+    installed = {'numpy': True, 'numexpr': numexpr is not None, 'numba': numba is not None}
+    return [backend for backend in KERNEL_BACKENDS if installed[backend]]
+
+
+# numpy
+def r_index_numpy(slope_array, aspect_array, west_angle, incidence_angle):
+    # "(Sin (([slope] * (Sin (([aspect] + [WA]) div 57.925)) - [IA]) div 57.295)) * -1"
+    return - numpy.sin(slope_array * (numpy.sin((aspect_array + west_angle) / 57.925) - incidence_angle) / 57.295)
+
+
+def cr_index_numpy(slope_array, aspect_array, land_use_index_array, west_angle, incidence_angle):
+    r_index_array = r_index_numpy(slope_array, aspect_array, west_angle, incidence_angle)
+    # "([R_index] - 0.3) * 2.857 + 1"
+    lu_weight_array = (r_index_array - 0.3) * 2.857 + 1
+    # "[R_index] > 0 AND Land_Use_Index > 0
+    zero_mask_array = numpy.logical_and(numpy.greater(r_index_array,0), numpy.greater(land_use_index_array, 0)).astype(int)
+
+    # "(([Land_Use_Index] * [Peso_LU]) + ([R_index] * 100)) / (1 + [Peso_LU]) * [Zero_Mask]"
+    return ((land_use_index_array * lu_weight_array) + (r_index_array * 100)) / (1 + lu_weight_array) * zero_mask_array
+
+
+def projection_factor_numpy(slope_array, aspect_array, alos, blos, clos):
+    # the denominator of VEL_PRJ:
+    # "(((cos(([slope]/57.29)))*(sin((([aspect]-90)/57.29)))*[ALOS])
+    #   +((-1)*(cos(([slope]/57.29)))*(cos((([aspect]-90)/57.29)))*[BLOS])
+    #   +((sin(([slope]/57.29)))*[CLOS]))"
+    slope_array = slope_array / 57.29
+    aspect_array = (aspect_array - 90) / 57.29
+    return (numpy.cos(slope_array) * (numpy.sin(aspect_array) * alos - numpy.cos(aspect_array) * blos)
+            + numpy.sin(slope_array) * clos)
+
+
+# numexpr
+R_INDEX_EXPRESSION = "-sin(slope * (sin((aspect + west_angle) / 57.925) - incidence_angle) / 57.295)"
+LU_WEIGHT_EXPRESSION = "((%s) - 0.3) * 2.857 + 1" % R_INDEX_EXPRESSION
+CR_INDEX_EXPRESSION = ("((land_use_index * (%s)) + ((%s) * 100)) / (1 + (%s))"
+                       " * where(((%s) > 0) & (land_use_index > 0), 1, 0)") % (
+                       LU_WEIGHT_EXPRESSION, R_INDEX_EXPRESSION, LU_WEIGHT_EXPRESSION, R_INDEX_EXPRESSION)
+PROJECTION_FACTOR_EXPRESSION = ("cos(slope / 57.29) * (sin((aspect - 90) / 57.29) * alos"
+                                " - cos((aspect - 90) / 57.29) * blos) + sin(slope / 57.29) * clos")
+
+
+def r_index_numexpr(slope_array, aspect_array, west_angle, incidence_angle):
+    return numexpr.evaluate(R_INDEX_EXPRESSION, local_dict={
+                                'slope': slope_array,
+                                'aspect': aspect_array,
+                                'west_angle': float(west_angle),
+                                'incidence_angle': float(incidence_angle)})
+
+
+def cr_index_numexpr(slope_array, aspect_array, land_use_index_array, west_angle, incidence_angle):
+    return numexpr.evaluate(CR_INDEX_EXPRESSION, local_dict={
+                                'slope': slope_array,
+                                'aspect': aspect_array,
+                                'land_use_index': land_use_index_array,
+                                'west_angle': float(west_angle),
+                                'incidence_angle': float(incidence_angle)})
+
+
+def projection_factor_numexpr(slope_array, aspect_array, alos, blos, clos):
+    return numexpr.evaluate(PROJECTION_FACTOR_EXPRESSION, local_dict={
+                                'slope': slope_array,
+                                'aspect': aspect_array,
+                                'alos': float(alos),
+                                'blos': float(blos),
+                                'clos': float(clos)})
+
+
+# numba, compiled at the first call
+_numba_kernels = {}
+
+
+def _numba_kernel(name):
+    if name in _numba_kernels:
+        return _numba_kernels[name]
+
+    if name == 'r_index':
+        @numba.njit(parallel=True, error_model='numpy')
+        def kernel(slope, aspect, west_angle, incidence_angle, out):
+            for i in numba.prange(out.size):
+                out[i] = - math.sin(slope[i] * (math.sin((aspect[i] + west_angle) / 57.925) - incidence_angle) / 57.295)
+    elif name == 'projection_factor':
+        @numba.njit(parallel=True, error_model='numpy')
+        def kernel(slope, aspect, alos, blos, clos, out):
+            for i in numba.prange(out.size):
+                s = slope[i] / 57.29
+                a = (aspect[i] - 90) / 57.29
+                out[i] = math.cos(s) * (math.sin(a) * alos - math.cos(a) * blos) + math.sin(s) * clos
+    else:
+        @numba.njit(parallel=True, error_model='numpy')
+        def kernel(slope, aspect, land_use_index, west_angle, incidence_angle, out):
+            for i in numba.prange(out.size):
+                r_index = - math.sin(slope[i] * (math.sin((aspect[i] + west_angle) / 57.925) - incidence_angle) / 57.295)
+                lu_weight = (r_index - 0.3) * 2.857 + 1
+                zero_mask = 1 if r_index > 0 and land_use_index[i] > 0 else 0
+                out[i] = ((land_use_index[i] * lu_weight) + (r_index * 100)) / (1 + lu_weight) * zero_mask
+
+    _numba_kernels[name] = kernel
+    return kernel
+
+
+def r_index_numba(slope_array, aspect_array, west_angle, incidence_angle):
+    out = numpy.empty(slope_array.shape, dtype=numpy.float64)
+    _numba_kernel('r_index')(
+            numpy.ascontiguousarray(slope_array).ravel(),
+            numpy.ascontiguousarray(aspect_array).ravel(),
+            float(west_angle),
+            float(incidence_angle),
+            out.ravel())
+    return out
+
+
+def cr_index_numba(slope_array, aspect_array, land_use_index_array, west_angle, incidence_angle):
+    out = numpy.empty(slope_array.shape, dtype=numpy.float64)
+    _numba_kernel('cr_index')(
+            numpy.ascontiguousarray(slope_array).ravel(),
+            numpy.ascontiguousarray(aspect_array).ravel(),
+            numpy.ascontiguousarray(land_use_index_array).ravel(),
+            float(west_angle),
+            float(incidence_angle),
+            out.ravel())
+    return out
+
+
+def projection_factor_numba(slope_array, aspect_array, alos, blos, clos):
+    out = numpy.empty(slope_array.shape, dtype=numpy.float64)
+    _numba_kernel('projection_factor')(
+            numpy.ascontiguousarray(slope_array, dtype=numpy.float64).ravel(),
+            numpy.ascontiguousarray(aspect_array, dtype=numpy.float64).ravel(),
+            float(alos),
+            float(blos),
+            float(clos),
+            out.ravel())
+    return out
+
+
+R_INDEX_KERNELS = {'numpy': r_index_numpy, 'numexpr': r_index_numexpr, 'numba': r_index_numba}
+CR_INDEX_KERNELS = {'numpy': cr_index_numpy, 'numexpr': cr_index_numexpr, 'numba': cr_index_numba}
+PROJECTION_FACTOR_KERNELS = {'numpy': projection_factor_numpy, 'numexpr': projection_factor_numexpr,
+                             'numba': projection_factor_numba}
+
+
+def _backend(backend):
+    # fall back to numpy when the backend is not installed
+    return backend if backend in available_backends() else 'numpy'
+
+
+def r_index(slope_array, aspect_array, west_angle, incidence_angle, backend='numpy'):
+    return R_INDEX_KERNELS[_backend(backend)](slope_array, aspect_array, west_angle, incidence_angle)
+
+
+def cr_index(slope_array, aspect_array, land_use_index_array, west_angle, incidence_angle, backend='numpy'):
+    return CR_INDEX_KERNELS[_backend(backend)](slope_array, aspect_array, land_use_index_array,
+                                               west_angle, incidence_angle)
+
+
+def projection_factor(slope_array, aspect_array, alos, blos, clos, backend='numpy'):
+    return PROJECTION_FACTOR_KERNELS[_backend(backend)](slope_array, aspect_array, alos, blos, clos)
+
+
+def projection(vel_array, slope_array, aspect_array, alos, blos, clos, backend='numpy'):
+    # "[VEL]*(1/<projection factor>)", return (projection factor, VEL_PRJ)
+    factor = projection_factor(slope_array, aspect_array, alos, blos, clos, backend)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return factor, vel_array / factor
+
+
+def projection_factor_range(alos, blos, clos):
+    # the projection factor is the dot product of (ALOS, BLOS, CLOS) and a
+    # unit vector: its absolute value is at most their norm
+    norm = math.sqrt(alos * alos + blos * blos + clos * clos)
+    return -norm, norm
@@ -0,0 +1,94 @@
+# test_grid_points
+# utils.grid_points against a point by point binning: every aggregation,
+# with points outside the extent, on the cell borders and nan values.
+
+import os
+import sys
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import utils
+except (ImportError, SyntaxError):     # no GDAL bindings, or not the python 2 of QGIS
+    utils = None
+
+
+def grid_reference(xs, ys, values, extent, cell_size, aggregation):
+    # the values of each cell in the points order, then aggregated
+    xmin, ymin, xmax, ymax = extent
+    cols = abs(int(round((xmax - xmin) / cell_size)))
+    rows = abs(int(round((ymax - ymin) / cell_size)))
+    cells = {}
+    for x, y, value in zip(xs, ys, values):
+        col = int(numpy.floor((x - xmin) / cell_size))
+        row = int(numpy.floor((ymax - y) / cell_size))
+        if 0 <= col < cols and 0 <= row < rows and not numpy.isnan(value):
+            cells.setdefault((row, col), []).append(value)
+
+    grid = numpy.empty((rows, cols))
+    grid.fill(0 if aggregation == 'count' else numpy.nan)
+    for (row, col), cell in cells.items():
+        if aggregation == 'mean':
+            grid[row, col] = numpy.mean(cell)
+        elif aggregation == 'median':
+            grid[row, col] = numpy.median(cell)
+        elif aggregation == 'count':
+            grid[row, col] = len(cell)
+        elif aggregation == 'last':
+            grid[row, col] = cell[-1]
+    return grid
+
+
+@unittest.skipIf(utils is None, "GDAL is not installed")
+class GridPointsTest(unittest.TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(2)
+        self.extent = (1000.0, 2000.0, 1500.0, 2300.0)     # 20 x 12 cells of 25
+        size = 3000
+        # a few points fall outside, some on the cell borders
+        self.xs = random.uniform(950, 1550, size)
+        self.ys = random.uniform(1950, 2350, size)
+        self.xs[:200] = numpy.round(self.xs[:200] / 25.0) * 25.0
+        self.ys[100:300] = numpy.round(self.ys[100:300] / 25.0) * 25.0
+        self.values = random.normal(0, 10, size)
+        self.values[::17] = numpy.nan
+        # integer values: the median of the cells with an even count
+        # is the mean of two equal or different values
+        self.values[::5] = numpy.round(self.values[::5])
+
+    def _check(self, aggregation):
+        grid = utils.grid_points(self.xs, self.ys, self.values, self.extent, 25, aggregation)
+        expected = grid_reference(self.xs, self.ys, self.values, self.extent, 25, aggregation)
+        self.assertEqual(grid.shape, (12, 20))
+        assert_allclose(grid, expected, rtol=1e-12, atol=1e-12)
+
+    def test_mean(self):
+        self._check('mean')
+
+    def test_median(self):
+        self._check('median')
+
+    def test_count(self):
+        self._check('count')
+
+    def test_last(self):
+        self._check('last')
+
+    def test_empty_cells(self):
+        # a single point: the other cells are empty
+        grid = utils.grid_points(numpy.array([1010.0]), numpy.array([2290.0]), numpy.array([3.0]),
+                                 self.extent, 25, 'median')
+        self.assertEqual(grid[0, 0], 3.0)
+        self.assertEqual(numpy.isnan(grid).sum(), grid.size - 1)
+
+    def test_unknown_aggregation(self):
+        self.assertRaises(Exception, utils.grid_points, self.xs, self.ys, self.values,
+                          self.extent, 25, 'max')
+
+
+if __name__ == '__main__':
+    unittest.main()
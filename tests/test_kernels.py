@@ -0,0 +1,149 @@
+# test_kernels
+# Parity of the kernel backends with the numpy reference (and of the
+# projection kernels with the original formula): every installed backend
+# must give the same results, the missing ones are skipped.
+
+import os
+import sys
+import math
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import kernels
+
+
+class KernelParity(object):
+    # the tests of a backend, see the TestCase classes below
+
+    backend = None
+
+    def setUp(self):
+        if self.backend not in kernels.available_backends():
+            self.skipTest("%s is not installed" % self.backend)
+
+        random = numpy.random.RandomState(0)
+        size = 10000
+        self.slope = random.uniform(0, 90, size)
+        self.aspect = random.uniform(0, 360, size)
+        self.land_use_index = random.uniform(-10, 100, size)
+
+    def test_r_index(self):
+        assert_allclose(kernels.r_index(self.slope, self.aspect, 12.5, 23.0, self.backend),
+                        kernels.r_index_numpy(self.slope, self.aspect, 12.5, 23.0),
+                        rtol=1e-9, atol=1e-12)
+
+    def test_cr_index(self):
+        assert_allclose(kernels.cr_index(self.slope, self.aspect, self.land_use_index, 12.5, 23.0, self.backend),
+                        kernels.cr_index_numpy(self.slope, self.aspect, self.land_use_index, 12.5, 23.0),
+                        rtol=1e-9, atol=1e-9)
+
+    def test_float32(self):
+        # the tiles of the rasters are float32: the backends compute in
+        # float64 as the numpy reference on the same values
+        slope, aspect = self.slope.astype(numpy.float32), self.aspect.astype(numpy.float32)
+        assert_allclose(kernels.r_index(slope, aspect, 12.5, 23.0, self.backend),
+                        kernels.r_index_numpy(slope.astype(numpy.float64), aspect.astype(numpy.float64), 12.5, 23.0),
+                        rtol=1e-9, atol=1e-12)
+
+    def test_projection_factor(self):
+        assert_allclose(kernels.projection_factor(self.slope, self.aspect, 0.6, 0.5, 0.8, self.backend),
+                        kernels.projection_factor_numpy(self.slope, self.aspect, 0.6, 0.5, 0.8),
+                        rtol=1e-9, atol=1e-12)
+
+
+class NumexprParityTest(KernelParity, unittest.TestCase):
+    backend = 'numexpr'
+
+
+class NumbaParityTest(KernelParity, unittest.TestCase):
+    backend = 'numba'
+
+
+
+# the VEL_PRJ formula of the first versions of PSProjectionTool, evaluated
+# point by point as utils.evaluate did (without the rounding)
+VEL_PRJ_FORMULA = ("[VEL]*(1/(((cos(([slope]/57.29)))*(sin((([aspect]-90)/57.29)))*[ALOS])"
+                   "+((-1)*(cos(([slope]/57.29)))*(cos((([aspect]-90)/57.29)))*[BLOS])"
+                   "+((sin(([slope]/57.29)))*[CLOS])))")
+PROJECTION_FACTOR_FORMULA = VEL_PRJ_FORMULA[len("[VEL]*(1/"):-1]   # the denominator
+COSINE_DIRECTORS = {'ALOS': 0.6, 'BLOS': 0.5, 'CLOS': 0.8}
+
+
+def evaluate(formula, values):
+    for name, value in values.items():
+        formula = formula.replace('[%s]' % name, repr(float(value)))
+    return eval(formula, {'sin': math.sin, 'cos': math.cos})
+
+
+class ProjectionFormula(object):
+    # the projection kernels of a backend against the original formula,
+    # on the edges of slope and aspect too
+
+    backend = None
+
+    def setUp(self):
+        if self.backend not in kernels.available_backends():
+            self.skipTest("%s is not installed" % self.backend)
+
+        slopes = [0.0, 0.001, 45.0, 89.999, 90.0]
+        aspects = [0.0, 0.001, 90.0, 180.0, 270.0, 359.999, 360.0]
+        edges = len(slopes) * len(aspects)
+        random = numpy.random.RandomState(1)
+        self.slope = numpy.concatenate([numpy.repeat(slopes, len(aspects)), random.uniform(0, 90, 2000)])
+        self.aspect = numpy.concatenate([numpy.tile(aspects, len(slopes)), random.uniform(0, 360, 2000)])
+        self.vel = numpy.concatenate([numpy.linspace(-20, 20, edges), random.normal(0, 10, 2000)])
+
+    def _values(self, i):
+        return dict(COSINE_DIRECTORS, VEL=self.vel[i], slope=self.slope[i], aspect=self.aspect[i])
+
+    def test_projection_factor(self):
+        expected = [evaluate(PROJECTION_FACTOR_FORMULA, self._values(i)) for i in range(len(self.vel))]
+        assert_allclose(kernels.projection_factor(self.slope, self.aspect, 0.6, 0.5, 0.8, self.backend),
+                        expected, rtol=0, atol=1e-12)
+
+    def test_vel_prj(self):
+        expected = numpy.array([evaluate(VEL_PRJ_FORMULA, self._values(i)) for i in range(len(self.vel))])
+        factor, vel_prj = kernels.projection(self.vel, self.slope, self.aspect, 0.6, 0.5, 0.8, self.backend)
+        # near a zero factor the division amplifies the rounding
+        stable = numpy.abs(factor) > 1e-3
+        self.assertTrue(stable.sum() > len(stable) * 0.9)
+        assert_allclose(vel_prj[stable], expected[stable], rtol=1e-9)
+
+    def test_zero_factor(self):
+        # a flat point with a vertical line of sight: the formula divides
+        # by zero, VEL_PRJ is inf
+        factor, vel_prj = kernels.projection(numpy.array([5.0, -5.0]), numpy.zeros(2), numpy.zeros(2),
+                                             0.0, 0.0, 0.8, self.backend)
+        assert_allclose(factor, [0.0, 0.0], atol=1e-15)
+        self.assertTrue(numpy.isinf(vel_prj).all())
+
+    def test_nan(self):
+        # the points outside the slope or aspect raster
+        factor, vel_prj = kernels.projection(numpy.array([1.0, 1.0]), numpy.array([numpy.nan, 10.0]),
+                                             numpy.array([10.0, numpy.nan]), 0.6, 0.5, 0.8, self.backend)
+        self.assertTrue(numpy.isnan(factor).all())
+        self.assertTrue(numpy.isnan(vel_prj).all())
+
+    def test_range(self):
+        low, high = kernels.projection_factor_range(0.6, 0.5, 0.8)
+        factor = kernels.projection_factor(self.slope, self.aspect, 0.6, 0.5, 0.8, self.backend)
+        self.assertTrue((factor >= low - 1e-12).all() and (factor <= high + 1e-12).all())
+
+
+class NumpyProjectionTest(ProjectionFormula, unittest.TestCase):
+    backend = 'numpy'
+
+
+class NumexprProjectionTest(ProjectionFormula, unittest.TestCase):
+    backend = 'numexpr'
+
+
+class NumbaProjectionTest(ProjectionFormula, unittest.TestCase):
+    backend = 'numba'
+
+
+if __name__ == '__main__':
+    unittest.main()
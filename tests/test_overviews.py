@@ -0,0 +1,105 @@
+# test_overviews
+# utils.StreamedOverviews against the overviews averaged from the whole
+# image: aligned and unaligned tiles, in any order, with nodata.
+
+import os
+import sys
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    from osgeo import gdal
+    import utils
+except (ImportError, SyntaxError):     # no GDAL bindings, or not the python 2 of QGIS
+    utils = None
+
+
+NODATA = -3.4e+38
+LEVELS = [2, 4, 8]
+
+
+def overview_reference(array, factor, nodata):
+    # the mean of the valid pixels of each factor x factor block (the
+    # last ones cut by the image borders), nodata for the empty blocks
+    rows, cols = array.shape
+    valid = array != numpy.asarray(nodata).astype(array.dtype)
+    overview = numpy.empty(((rows + factor - 1) // factor, (cols + factor - 1) // factor))
+    for y in range(overview.shape[0]):
+        for x in range(overview.shape[1]):
+            block = array[y * factor:(y + 1) * factor, x * factor:(x + 1) * factor]
+            block_valid = valid[y * factor:(y + 1) * factor, x * factor:(x + 1) * factor]
+            if block_valid.any():
+                overview[y, x] = block[block_valid].astype(numpy.float64).mean()
+            else:
+                overview[y, x] = nodata
+    return overview
+
+
+@unittest.skipIf(utils is None, "GDAL is not installed")
+class StreamedOverviewsTest(unittest.TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(4)
+        self.cols, self.rows = 203, 150
+        self.array = random.normal(0, 10, (self.rows, self.cols)).astype(numpy.float32)
+        self.array[random.uniform(size=self.array.shape) < 0.2] = NODATA
+        self.array[40:60, 50:90] = NODATA       # whole empty blocks
+        self.path = '/vsimem/test_overviews_%d.tif' % os.getpid()
+
+    def tearDown(self):
+        gdal.Unlink(self.path)
+
+    def _write(self, array, tile_width, tile_height, shuffle=False):
+        # write the image a tile at a time, return the overviews read back
+        dst = gdal.GetDriverByName('GTiff').Create(self.path, self.cols, self.rows, 1, gdal.GDT_Float32)
+        overviews = utils.StreamedOverviews(dst, LEVELS, NODATA)
+        windows = list(utils.raster_windows(self.cols, self.rows, tile_width, tile_height))
+        if shuffle:
+            numpy.random.RandomState(5).shuffle(windows)
+        for xoff, yoff, width, height in windows:
+            tile = array[yoff:yoff + height, xoff:xoff + width]
+            dst.GetRasterBand(1).WriteArray(tile, xoff, yoff)
+            overviews.write(1, tile, xoff, yoff)
+
+        # every block across the tile borders is complete, none is left
+        # to close
+        self.assertEqual(overviews.partial, {})
+        overviews.close()
+        band = dst.GetRasterBand(1)
+        arrays = [band.GetOverview(i).ReadAsArray() for i in range(len(LEVELS))]
+        band = dst = None
+        return arrays
+
+    def _check(self, tile_width, tile_height, shuffle=False, array=None):
+        if array is None:
+            array = self.array
+        for factor, overview in zip(LEVELS, self._write(array, tile_width, tile_height, shuffle)):
+            expected = overview_reference(self.array, factor, NODATA)
+            self.assertEqual(overview.shape, expected.shape)
+            assert_allclose(overview, expected.astype(numpy.float32), rtol=1e-5, atol=1e-5)
+
+    def test_aligned_tiles(self):
+        self._check(64, 32)
+
+    def test_unaligned_tiles(self):
+        self._check(37, 23)
+
+    def test_any_order(self):
+        self._check(37, 23, shuffle=True)
+
+    def test_single_tile(self):
+        self._check(self.cols, self.rows)
+
+    def test_float64_tiles(self):
+        # the grids of the speed algorithms: float64 with the nodata as
+        # float64 (not the same number as the float32 one)
+        array = self.array.astype(numpy.float64)
+        array[self.array == numpy.float32(NODATA)] = NODATA
+        self._check(37, 23, array=array)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# test_solve_tracks
+# PSLOSDecomposition.solve_tracks against a cell by cell weighted least
+# squares, with cells missing some tracks (down to too few to solve).
+
+import os
+import sys
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import PSLOSDecomposition
+except (ImportError, SyntaxError):     # no GDAL bindings or processing, or not the python 2 of QGIS
+    PSLOSDecomposition = None
+
+
+# (cd_e, cd_n, cd_u) of two ascending and two descending tracks
+COSINE_DIRECTORS = [(-0.61, -0.11, 0.78), (-0.55, -0.10, 0.83),
+                    (0.60, -0.11, 0.79), (0.66, -0.12, 0.74)]
+WEIGHTS = [1.0, 0.5, 2.0, 1.5]
+
+
+def solve_reference(grids, cosine_directors, weights, model, max_condition):
+    # the normal equations of each cell from its valid tracks
+    columns = ['ENU'.index(c) for c in model]
+    rows, cols = grids[0].shape
+    k = len(columns)
+    outputs = [numpy.empty((rows, cols)) for i in range(k + 2)]
+    for output in outputs:
+        output.fill(numpy.nan)
+
+    for row in range(rows):
+        for col in range(cols):
+            design, los, w = [], [], []
+            for grid, cds, weight in zip(grids, cosine_directors, weights):
+                if not numpy.isnan(grid[row, col]):
+                    design.append([cds[c] for c in columns])
+                    los.append(grid[row, col])
+                    w.append(weight)
+            design = numpy.array(design, dtype=numpy.float64).reshape(len(los), k)
+            los, w = numpy.array(los), numpy.array(w)
+
+            normal = design.T.dot(w[:, None] * design)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                condition = numpy.linalg.cond(normal)
+            outputs[k + 1][row, col] = condition
+            if not (numpy.isfinite(condition) and condition <= max_condition):
+                continue
+
+            x = numpy.linalg.solve(normal, design.T.dot(w * los))
+            residuals = los - design.dot(x)
+            for j in range(k):
+                outputs[j][row, col] = x[j]
+            outputs[k][row, col] = numpy.sqrt((w * residuals ** 2).sum() / w.sum())
+    return outputs
+
+
+@unittest.skipIf(PSLOSDecomposition is None, "QGIS processing or GDAL is not installed")
+class SolveTracksTest(unittest.TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(3)
+        self.rows, self.cols = 30, 17
+        self.extent = (0.0, 0.0, self.cols * 25.0, self.rows * 25.0)
+        east, north, up = [random.normal(0, 5, (self.rows, self.cols)) for i in range(3)]
+
+        # every track misses some cells; the first row is seen by every
+        # track, the second one by the first track only
+        self.grids = []
+        for i, (cd_e, cd_n, cd_u) in enumerate(COSINE_DIRECTORS):
+            grid = cd_e * east + cd_n * north + cd_u * up + random.normal(0, 0.5, east.shape)
+            missing = random.uniform(size=grid.shape) < 0.15 * (i + 1)
+            missing[0] = False
+            missing[1] = i > 0
+            grid[missing] = numpy.nan
+            self.grids.append(grid)
+
+        # more chunks of rows than one
+        self.chunk_cells = PSLOSDecomposition.LSQ_CHUNK_CELLS
+        PSLOSDecomposition.LSQ_CHUNK_CELLS = 4 * self.cols
+
+    def tearDown(self):
+        PSLOSDecomposition.LSQ_CHUNK_CELLS = self.chunk_cells
+
+    def _check(self, model, max_condition=1e6):
+        outputs = PSLOSDecomposition.solve_tracks(self.grids, COSINE_DIRECTORS, WEIGHTS,
+                                                  self.extent, 25.0, model, max_condition)
+        expected = solve_reference(self.grids, COSINE_DIRECTORS, WEIGHTS, model, max_condition)
+        k = len(model)
+        self.assertEqual(len(outputs), k + 2)
+
+        # the same cells are solved, with the same components and residuals
+        solved = ~numpy.isnan(expected[0])
+        for output, reference in zip(outputs[:k + 1], expected[:k + 1]):
+            self.assertTrue((numpy.isnan(output) == numpy.isnan(reference)).all())
+            assert_allclose(output[solved], reference[solved], rtol=1e-4, atol=1e-4)
+
+        # the condition number where it is meaningful (the singular
+        # matrices give inf or a huge number, both above the maximum)
+        conditioned = expected[k + 1] < 1e10
+        assert_allclose(outputs[k + 1][conditioned], expected[k + 1][conditioned], rtol=1e-4)
+        self.assertTrue((outputs[k + 1][~conditioned] > max_condition).all())
+        return outputs, expected
+
+    def test_enu(self):
+        outputs, expected = self._check('ENU')
+        solved = ~numpy.isnan(outputs[0])
+        self.assertTrue(solved[0].all())
+        self.assertTrue(solved.any() and not solved.all())
+
+    def test_eu(self):
+        outputs, expected = self._check('EU')
+        self.assertTrue((~numpy.isnan(outputs[0][0])).all())
+
+    def test_single_track(self):
+        # a cell seen by one track only is not solved
+        outputs, expected = self._check('EU')
+        self.assertTrue(numpy.isnan(outputs[0][1]).all())
+
+    def test_max_condition(self):
+        # North is badly resolved by these geometries: a low maximum
+        # leaves every ENU cell empty
+        outputs, expected = self._check('ENU', max_condition=10.0)
+        self.assertTrue(numpy.isnan(outputs[0]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,20 @@
 # utils
 
 import sys, os
-import struct
+import multiprocessing
+import re
+import ast
+import numbers
+import errno
+import hashlib
 import random
+import tempfile
+import uuid
+import time
+import json
+from collections import OrderedDict, deque
 from math import sin, cos
-from osgeo import gdal, ogr
+from osgeo import gdal, ogr, gdal_array
 import numpy
 
 
@@ -15,13 +25,109 @@ def ogr_extent(shape_input_path):
     if orig_data_source is None:
         raise Exception('No suitable type')
 
-    source_ds = ogr.GetDriverByName("Memory").CopyDataSource(orig_data_source, "")
-    source_layer = source_ds.GetLayer(0)
-    source_srs = source_layer.GetSpatialRef()
-    x_min, x_max, y_min, y_max = source_layer.GetExtent()
+    # the extent of the header, the features are not read
+    x_min, x_max, y_min, y_max = orig_data_source.GetLayer(0).GetExtent()
     return x_min, x_max, y_min, y_max
 
 
+# Spatial index
+# The PS points are read only inside the extent of the run: the layers are
+# filtered by rectangle and the shapefiles get a .qix spatial index (built
+# once, next to the file, when the folder is writable) so that the driver
+# skips the other features. Two processes writing the same .qix race: the
+# indexes are built in the parent before dispatching the workers (see
+# grid_point_files).
+SPATIAL_INDEX_EXTENSIONS = ['.qix', '.sbn', '.sbx']
+
+
+def spatial_index(shape_input_path):
+    # build the .qix of a shapefile if it has no spatial index and its
+    # folder is writable; True if the file has one (the other formats are
+    # left as they are)
+    stem, extension = os.path.splitext(shape_input_path)
+    if extension.lower() != '.shp' or not os.path.isfile(shape_input_path):
+        return False
+    if any(os.path.exists(stem + ext) for ext in SPATIAL_INDEX_EXTENSIONS):
+        return True
+    if not os.access(os.path.dirname(os.path.abspath(shape_input_path)), os.W_OK):
+        return False                                # read only folder: no index
+
+    data_source = ogr.Open(shape_input_path, 1)     # update
+    if data_source is None:
+        return False                                # read only file: no index
+    layer_name = data_source.GetLayer(0).GetName()
+    data_source.ExecuteSQL('CREATE SPATIAL INDEX ON "%s"' % layer_name)
+    data_source = None
+    return os.path.exists(stem + '.qix')
+
+
+def filter_layer(layer, extent):
+    # read only the features of a layer intersecting the extent
+    # (xmin, ymin, xmax, ymax, see convert_parameter), None for all
+    if extent is None:
+        layer.SetSpatialFilter(None)
+    else:
+        xmin, ymin, xmax, ymax = extent
+        layer.SetSpatialFilterRect(xmin, ymin, xmax, ymax)
+
+
+def open_points(shape_input_path, extent=None):
+    # open a vector file of points filtered on the extent (see filter_layer),
+    # through the spatial index; return the (data source, layer)
+    if extent is not None:
+        spatial_index(shape_input_path)
+    data_source = ogr.Open(shape_input_path)
+
+    if data_source is None:
+        raise Exception('No suitable type')
+
+    layer = data_source.GetLayer(0)
+    filter_layer(layer, extent)
+    return data_source, layer
+
+
+# Intermediate rasters
+# Intermediate rasters (the uncompressed copy of a 'cog' output, see
+# create_output) are kept in /vsimem/ with a unique name for each run; the
+# ones bigger than INTERMEDIATE_MEMORY_LIMIT bytes are written in a scratch
+# directory (None: the system temporary directory).
+INTERMEDIATE_MEMORY_LIMIT = 512 * 1024 * 1024
+
+
+def raster_nbytes(cols, rows, bands=1, data_type=gdal.GDT_Float32):
+    # size in bytes of a raster image
+    return cols * rows * bands * gdal.GetDataTypeSize(data_type) // 8
+
+
+def intermediate_raster_path(name, nbytes=0, scratch_dir=None, memory_limit=None):
+    """
+      A unique path for an intermediate GeoTIFF
+      @param name            : prefix of the file name
+      @param nbytes          : expected size of the raster
+      @param scratch_dir     : directory used above the memory limit, None
+                               for the system temporary directory
+      @param memory_limit    : max size in bytes kept in /vsimem/
+
+      @return: the path, to be removed with remove_intermediate_raster
+    """
+    if memory_limit is None:
+        memory_limit = INTERMEDIATE_MEMORY_LIMIT
+    filename = '%s_%d_%s.tiff' % (name, os.getpid(), uuid.uuid4().hex)
+
+    if nbytes <= memory_limit:
+        return '/vsimem/' + filename
+
+    return os.path.join(scratch_dir or tempfile.gettempdir(), filename)
+
+
+def remove_intermediate_raster(path):
+    # remove an intermediate raster, in memory or on disk
+    if path.startswith('/vsimem/'):
+        gdal.Unlink(path)
+    elif os.path.exists(path):
+        gdal.GetDriverByName('GTiff').Delete(path)
+
+
 # Rasterization
 RASTERIZE_COLOR_FIELD = "__color__"
 
@@ -86,30 +192,1085 @@ def rasterize(shape_input_path, raster_output_path, pixel_size=25):
     if err != 0:
         raise Exception("error rasterizing layer: %s" % err)
 
+# Gridding
+GRID_AGGREGATIONS = ['mean', 'median', 'count', 'last']
+
+def read_point_field(shape_input_path, fieldname, extent=None):
+    # read the coordinates and a field of the points in a vector file,
+    # only the ones in the extent if given (see open_points); return the
+    # numpy arrays x, y, values
+    data_source, layer = open_points(shape_input_path, extent)
+    xs, ys, columns = read_layer_columns(layer, [fieldname])
+    return xs, ys, columns[fieldname]
+
+
+def grid_points(xs, ys, values, extent, cell_size, aggregation='mean'):
+    """
+      Bin the points on the grid of an extent
+      @param xs, ys          : numpy arrays of coordinates in map units
+      @param values          : numpy array of the point values (nan are skipped)
+      @param extent          : xmin, ymin, xmax, ymax (see convert_parameter)
+      @param cell_size       : size of the cells in map units
+      @param aggregation     : one of GRID_AGGREGATIONS
+
+      @return: numpy float64 array (rows, cols), north up, nan for empty cells
+    """
+    if aggregation not in GRID_AGGREGATIONS:
+        raise Exception("Unknown aggregation: %s" % aggregation)
+
+    xmin, ymin, xmax, ymax = extent
+    cols, rows = extent_size(extent, cell_size)
+
+    # cell index of each point
+    col = numpy.floor((xs - xmin) / cell_size)
+    row = numpy.floor((ymax - ys) / cell_size)
+    inside = (col >= 0) & (col < cols) & (row >= 0) & (row < rows) & ~numpy.isnan(values)
+    cells = (row[inside] * cols + col[inside]).astype(numpy.int64)
+    values = values[inside]
+
+    grid = numpy.empty(rows * cols, dtype=numpy.float64)
+    grid.fill(numpy.nan)
+    counts = numpy.bincount(cells, minlength=rows * cols)
+
+    if aggregation == 'count':
+        grid[:] = counts
+
+    elif aggregation == 'mean':
+        sums = numpy.bincount(cells, weights=values, minlength=rows * cols)
+        full = counts > 0
+        grid[full] = sums[full] / counts[full]
+
+    elif aggregation == 'last':
+        # the last point in the layer order wins, as in gdal.RasterizeLayer
+        reversed_cells, first = numpy.unique(cells[::-1], return_index=True)
+        grid[reversed_cells] = values[::-1][first]
+
+    elif aggregation == 'median':
+        order = numpy.lexsort((values, cells))
+        cells, values = cells[order], values[order]
+        full = numpy.flatnonzero(counts)
+        starts = numpy.cumsum(counts[full]) - counts[full]
+        low = starts + (counts[full] - 1) // 2
+        high = starts + counts[full] // 2
+        grid[full] = (values[low] + values[high]) / 2.0
+
+    return grid.reshape(rows, cols)
+
+
+def grid_point_file(shape_input_path, fieldname, extent, cell_size, aggregation='mean'):
+    # the field of the points in a vector file binned on the grid of an
+    # extent (see grid_points)
+    xs, ys, values = read_point_field(shape_input_path, fieldname, extent)
+    return grid_points(xs, ys, values, extent, cell_size, aggregation)
+
+
+def grid_key(shape_input_path, fieldname, extent, cell_size, aggregation='mean'):
+    # the arguments of grid_point_file as a hashable tuple (the numbers as
+    # floats: a cell size of 25 or 25.0 is the same grid)
+    return (shape_input_path, fieldname, tuple(float(value) for value in extent),
+            float(cell_size), aggregation)
+
+
+def _grid_point_file(key):
+    return grid_point_file(*key)
+
+
+def _cached_grid_point_file(key):
+    return cached_grid_point_file(*key)
+
+
+def iter_grid_point_files(keys, workers=1, cache=False):
+    # grid_point_file for each grid_key, on a pool of workers processes
+    # (0 for all the cores), through the grid cache if cache; yield
+    # (key, array) in the order of the keys. At most workers grids are
+    # computed ahead of the one yielded, so the memory is bounded by the
+    # workers and by the grids the caller keeps, not by the keys
+    keys = list(keys)
+    function = _cached_grid_point_file if cache else _grid_point_file
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    workers = min(int(workers), len(keys))
+
+    if workers <= 1:
+        for key in keys:
+            yield key, function(key)
+        return
+
+    # the spatial indexes are built here, once, the workers only read them
+    for shape_input_path in set(key[0] for key in keys):
+        spatial_index(shape_input_path)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for key in keys:
+            pending.append((key, pool.apply_async(function, (key,))))
+            if len(pending) > workers:
+                key, result = pending.popleft()
+                yield key, result.get()
+        while pending:
+            key, result = pending.popleft()
+            yield key, result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def grid_point_files(keys, workers=1, cache=False):
+    # the list of the arrays of iter_grid_point_files, all in memory
+    return [grid for key, grid in iter_grid_point_files(keys, workers, cache)]
+
+
+# Grid cache
+# The grids of grid_point_file are kept on disk as .npy files named after
+# the hash of the grid_key and of the size and mtime of the vector files;
+# above GRID_CACHE_SIZE bytes the least recently used are removed.
+GRID_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pstools', 'grid_cache')
+GRID_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+
+def _source_signature(shape_input_path):
+    # name, size and mtime of a vector file and of its sidecar files
+    # (.dbf, .shx, ...)
+    directory, filename = os.path.split(os.path.abspath(shape_input_path))
+    stem = os.path.splitext(filename)[0] + '.'
+    signature = []
+    for name in sorted(os.listdir(directory)):
+        if name == filename or (name.startswith(stem) and
+                                os.path.splitext(name)[1].lower() not in SPATIAL_INDEX_EXTENSIONS):
+            stat = os.stat(os.path.join(directory, name))
+            signature.append((name, stat.st_size, stat.st_mtime))
+    return os.path.join(directory, filename), signature
+
+
+def grid_cache_path(key):
+    # the cache file of a grid_key
+    signature = (_source_signature(key[0]),) + tuple(key[1:])
+    digest = hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()
+    return os.path.join(GRID_CACHE_DIR, digest + '.npy')
+
+
+def evict_grid_cache(max_size=None):
+    # remove the least recently used grids above max_size bytes
+    # (None: GRID_CACHE_SIZE)
+    if max_size is None:
+        max_size = GRID_CACHE_SIZE
+    if not os.path.isdir(GRID_CACHE_DIR):
+        return
+
+    entries = []
+    for name in os.listdir(GRID_CACHE_DIR):
+        if name.endswith('.npy'):
+            path = os.path.join(GRID_CACHE_DIR, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass            # removed by another run
+        total -= size
+
+
+def cached_grid_point_file(shape_input_path, fieldname, extent, cell_size, aggregation='mean'):
+    # grid_point_file through the grid cache (only for files on disk)
+    key = grid_key(shape_input_path, fieldname, extent, cell_size, aggregation)
+    if not os.path.isfile(shape_input_path):
+        return grid_point_file(*key)
+
+    path = grid_cache_path(key)
+    if os.path.exists(path):
+        try:
+            grid = numpy.load(path)
+            os.utime(path, None)    # last use, for the eviction
+            return grid
+        except (IOError, OSError, ValueError):
+            pass                    # broken or removed, computed again
+
+    grid = grid_point_file(*key)
+
+    try:
+        os.makedirs(GRID_CACHE_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:  # created by another run
+            raise
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as tmp:
+        numpy.save(tmp, grid)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)         # already written by another run
+    evict_grid_cache()
+    return grid
+
+
+def shared_grid_point_file(input_path, vel_field, extent, point_size, aggregation='mean',
+                           grids=None, grid_cache=False):
+    # the velocities of the PS points of a speed algorithm binned on the
+    # extent grid, through the grid cache if grid_cache and kept in grids
+    # (None or dictionary grid_key:array shared between runs)
+    key = grid_key(input_path, vel_field, extent, point_size, aggregation)
+    function = cached_grid_point_file if grid_cache else grid_point_file
+    if grids is None:
+        return function(*key)
+    if key not in grids:
+        grids[key] = function(*key)
+    return grids[key]
+
+
+# Dataset pool
+# The raster images read by the algorithms are opened once in the process
+# and shared: acquire_dataset returns the open dataset of a path (opened
+# again if the file changed), release_dataset ends a use of it. The
+# datasets unused for DATASET_IDLE_TIMEOUT seconds are closed at the next
+# acquire or release, so the GDAL block cache stays warm between the
+# algorithms of a model. The pool belongs to a process: a forked worker
+# does not use the datasets of its parent (they share the file handles
+# and offsets), it opens its own.
+DATASET_IDLE_TIMEOUT = 300      # seconds
+
+_dataset_pool = {}              # path: entry, see acquire_dataset
+_dataset_pool_pid = None        # process of the pool
+
+
+def _process_dataset_pool():
+    # the dataset pool of this process, the one inherited from the
+    # parent is dropped
+    global _dataset_pool_pid
+    if _dataset_pool_pid != os.getpid():
+        _dataset_pool.clear()
+        _dataset_pool_pid = os.getpid()
+    return _dataset_pool
+
+
+def acquire_dataset(path):
+    # the pooled gdal dataset of a raster image, read only
+    path = str(path)
+    stat = gdal.VSIStatL(path)
+    key = (path, stat.mtime, stat.size) if stat else (path,)
+
+    pool = _process_dataset_pool()
+    entry = pool.get(path)
+    if entry is None or entry['key'] != key:
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        if ds is None:
+            raise Exception("Unable to open %s" % path)
+        entry = pool[path] = {
+            'key': key,
+            'ds': ds,
+            'users': 0,
+            'released': None,       # time of the last release
+            'reader': None,         # ClipReader of band 1, see _clip_reader
+        }
+    entry['users'] += 1
+
+    close_idle_datasets()
+    return entry['ds']
+
+
+def release_dataset(path):
+    # end a use of a dataset of acquire_dataset
+    entry = _process_dataset_pool().get(str(path))
+    if entry is not None and entry['users'] > 0:
+        entry['users'] -= 1
+        if not entry['users']:
+            entry['released'] = time.time()
+
+    close_idle_datasets()
+
+
+def close_idle_datasets(timeout=None):
+    # remove from the pool the datasets unused for timeout seconds
+    # (None: DATASET_IDLE_TIMEOUT, 0: all the unused ones); they are
+    # closed when the last reference to them is dropped
+    if timeout is None:
+        timeout = DATASET_IDLE_TIMEOUT
+    now = time.time()
+    pool = _process_dataset_pool()
+    for path, entry in list(pool.items()):
+        if not entry['users'] and entry['released'] is not None and now - entry['released'] >= timeout:
+            del pool[path]
+
+
 # Image clipping
-def clip_from_extent_as_array(src_path, extent):
+def band_nodata(band):
+    # the nodata value of a band in the type of its pixels, to compare with
+    # them (-3.4e+38 is not the same number in float32 and float64); None
+    # without nodata
+    nodata = band.GetNoDataValue()
+    if nodata is None:
+        return None
+    return numpy.asarray(nodata).astype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+
+
+class ClipReader:
+    # Read the window of an extent from a band of a raster image.
+    # The dataset and its geotransform are opened once and reused; the
+    # parts of the extent outside the image are filled with nodata.
+
+    def __init__(self, src, band=1):
+        # src: path or gdal raster obj (no rotation)
+        self.ds = gdal.Open(str(src)) if isinstance(src, basestring) else src
+        if self.ds is None:
+            raise Exception("Unable to open %s" % src)
+
+        self.gt = self.ds.GetGeoTransform()
+        self.band = self.ds.GetRasterBand(band)
+        self.cols, self.rows = self.ds.RasterXSize, self.ds.RasterYSize
+        self.nodata = self.band.GetNoDataValue()
+        self.dtype = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(self.band.DataType))
+
+    def window(self, extent):
+        # the window (xoff, yoff, width, height) of the extent, in pixels
+        # of the image; it may fall partly or totally outside the image
+        xmin, ymin, xmax, ymax = extent
+        x_size, y_size = self.gt[1], self.gt[5]
+        top = ymax if y_size < 0 else ymin
+
+        xoff = int(round((xmin - self.gt[0]) / x_size))
+        yoff = int(round((top - self.gt[3]) / y_size))
+        width = abs(int(round((xmax - xmin) / x_size)))
+        height = abs(int(round((ymax - ymin) / y_size)))
+        return xoff, yoff, width, height
+
+    def read(self, extent, dtype=None, out=None, fill=None):
+        """
+          Read the window of an extent
+          @param extent          : xmin, ymin, xmax, ymax (see convert_parameter)
+          @param dtype           : numpy type of the result, None for the band type
+          @param out             : numpy array (height, width) to read into
+          @param fill            : value outside the image, None for the band
+                                   nodata (nan for float types without it, else 0)
+
+          @return: the numpy array
+        """
+        xoff, yoff, width, height = self.window(extent)
+
+        if out is None:
+            out = numpy.empty((height, width), dtype=dtype or self.dtype)
+        elif out.shape != (height, width):
+            raise Exception("Wrong buffer shape %s, expected %s" % (out.shape, (height, width)))
+
+        # intersection with the image
+        x0, y0 = max(xoff, 0), max(yoff, 0)
+        x1, y1 = min(xoff + width, self.cols), min(yoff + height, self.rows)
+
+        if x0 >= x1 or y0 >= y1 or (x1 - x0, y1 - y0) != (width, height):
+            if fill is None:
+                fill = self.nodata
+            if fill is None:
+                fill = numpy.nan if out.dtype.kind == 'f' else 0
+            out.fill(fill)
+            if x0 >= x1 or y0 >= y1:
+                return out
+
+        view = out[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff]
+        if view.flags.c_contiguous:
+            self.band.ReadAsArray(x0, y0, x1 - x0, y1 - y0, buf_obj=view)
+        else:
+            view[...] = self.band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        return out
+
+
+def _clip_reader(src_path):
+    # the (key, ClipReader) of band 1 of an image of the dataset pool
+    ds = acquire_dataset(src_path)
+    try:
+        entry = _process_dataset_pool()[str(src_path)]
+        if entry['reader'] is None:
+            entry['reader'] = ClipReader(ds)
+        return entry['key'], entry['reader']
+    finally:
+        release_dataset(src_path)
+
+
+def clip_from_extent_as_array(src_path, extent, dtype=None, out=None):
     # Clip the raster image and return the matrix as numpy array
-    # FIXME => review the convertions to make ReadAsArray work correctly
-    
-    src_img = gdal.Open(src_path)
-    src_band = src_img.GetRasterBand(1)
-    [src_ulx, src_x_size, src_x_rotation, src_uly, src_y_rotation, src_y_size] = src_img.GetGeoTransform()    
+    # (see ClipReader.read); the images are opened in the dataset pool
+    return _clip_reader(src_path)[1].read(extent, dtype, out)
 
-    new_ulx, new_uly, new_lrx, new_lry = extent
 
-    # convert to matrix coordinates
-    xo = abs(int(round((new_ulx - src_ulx) / src_x_size)))    # cols origin
-    yo = abs(int(round((new_uly - src_uly) / src_y_size)))    # rows origin
+# Tiling
+def tile_shape(band, tile_size=None):
+    # the tile (width, height): the native block of the band or a square
+    # of tile_size pixels
+    if tile_size:
+        return int(tile_size), int(tile_size)
+    return tuple(band.GetBlockSize())
 
-    new_width = abs(int(round((new_lrx - new_ulx) / src_x_size)))    # number of cols
-    new_height = abs(int(round((new_lry - new_uly) / src_y_size)))   # number of rows
 
-    # logs
-    print 'clip:', src_path
-    print "ulx:%s x_size:%s x_rotation:%s uly:%s y_rotation:%s y_size:%s"%(src_ulx, src_x_size, src_x_rotation, src_uly, src_y_rotation, src_y_size)
-    print 'o: %s,%s size: %s,%s  '%(xo, yo, new_width, new_height)
-    
-    return src_band.ReadAsArray(xo, yo, new_width, new_height)
+def raster_windows(cols, rows, tile_width, tile_height):
+    # iterate on the windows (xoff, yoff, width, height) covering an image
+    for yoff in range(0, rows, tile_height):
+        for xoff in range(0, cols, tile_width):
+            yield (xoff, yoff,
+                   min(tile_width, cols - xoff),
+                   min(tile_height, rows - yoff))
+
+
+# Terrain
+# Slope and aspect of a DEM are computed on demand, a tile at a time, with
+# the Horn kernel (as gdaldem) on the tile plus a halo of a pixel; the
+# tiles are kept in memory for the next algorithms of the session.
+TERRAIN_PRODUCTS = ['slope', 'aspect']
+TERRAIN_CACHE_SIZE = 256 * 1024 * 1024      # bytes
+
+_terrain_tiles = OrderedDict()              # least recently used first
+_terrain_nbytes = 0                         # bytes of the cached tiles
+
+
+def read_with_halo(reader, xoff, yoff, width, height, halo=1):
+    # float64 window of a ClipReader plus a halo of pixels, nan for nodata;
+    # outside the image the edge pixels are repeated
+    x0, y0 = max(xoff - halo, 0), max(yoff - halo, 0)
+    x1 = min(xoff + width + halo, reader.cols)
+    y1 = min(yoff + height + halo, reader.rows)
+
+    array = reader.band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+    nodata = band_nodata(reader.band)
+    invalid = array == nodata if nodata is not None else None
+    array = array.astype(numpy.float64)
+    if invalid is not None:
+        array[invalid] = numpy.nan
+
+    pad = ((y0 - (yoff - halo), (yoff + height + halo) - y1),
+           (x0 - (xoff - halo), (xoff + width + halo) - x1))
+    return numpy.pad(array, pad, mode='edge')
+
+
+def horn_slope_aspect(dem, x_size, y_size):
+    """
+      Slope and aspect of a DEM with the Horn kernel, as gdaldem
+      @param dem             : numpy array with a halo of a pixel on every side
+      @param x_size, y_size  : pixel size in map units (the same of the heights)
+
+      @return: (slope, aspect) float32 arrays without the halo, in degrees;
+               aspect is clockwise from north, -9999 on flat cells; nan
+               where the 3x3 window has nodata
+    """
+    a, b, c = dem[:-2, :-2], dem[:-2, 1:-1], dem[:-2, 2:]
+    d, f = dem[1:-1, :-2], dem[1:-1, 2:]
+    g, h, i = dem[2:, :-2], dem[2:, 1:-1], dem[2:, 2:]
+
+    with numpy.errstate(invalid='ignore'):
+        dx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8.0 * abs(x_size))    # eastwards
+        dy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8.0 * abs(y_size))    # southwards
+
+        slope = numpy.degrees(numpy.arctan(numpy.hypot(dx, dy)))
+
+        aspect = numpy.degrees(numpy.arctan2(dy, -dx))
+        aspect = numpy.where(aspect > 90, 450 - aspect, 90 - aspect)
+        aspect[aspect == 360] = 0
+        aspect[(dx == 0) & (dy == 0)] = -9999
+
+    return slope.astype(numpy.float32), aspect.astype(numpy.float32)
+
+
+def terrain_tile(dem_path, xoff, yoff, width, height):
+    # the (slope, aspect) of a window of a DEM, from the cache or computed
+    global _terrain_nbytes
+    key, reader = _clip_reader(dem_path)
+    tile_key = (key, xoff, yoff, width, height)
+
+    tile = _terrain_tiles.pop(tile_key, None)
+    if tile is None:
+        dem = read_with_halo(reader, xoff, yoff, width, height)
+        tile = horn_slope_aspect(dem, reader.gt[1], reader.gt[5])
+        _terrain_nbytes += tile[0].nbytes + tile[1].nbytes
+    _terrain_tiles[tile_key] = tile     # the most recently used
+
+    while _terrain_nbytes > TERRAIN_CACHE_SIZE and len(_terrain_tiles) > 1:
+        slope, aspect = _terrain_tiles.popitem(last=False)[1]
+        _terrain_nbytes -= slope.nbytes + aspect.nbytes
+    return tile
+
+
+class TerrainSource(object):
+    # The slope or the aspect of a DEM in place of a raster image: it has
+    # the part of the gdal dataset and band interface used by map_tiles,
+    # tile_shape and sample_raster_at_points. The arrays read are shared
+    # with the cache and must not be modified.
+
+    def __init__(self, dem_path, product='slope'):
+        if product not in TERRAIN_PRODUCTS:
+            raise Exception("Unknown terrain product %s" % product)
+        self.dem_path = str(dem_path)
+        self.product = product
+
+    @property
+    def _reader(self):
+        return _clip_reader(self.dem_path)[1]
+
+    @property
+    def RasterXSize(self):
+        return self._reader.cols
+
+    @property
+    def RasterYSize(self):
+        return self._reader.rows
+
+    def GetGeoTransform(self):
+        return self._reader.gt
+
+    def GetRasterBand(self, band=1):
+        return self
+
+    def GetBlockSize(self):
+        return self._reader.band.GetBlockSize()
+
+    def GetNoDataValue(self):
+        return None     # nan
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None):
+        if win_xsize is None:
+            win_xsize = self.RasterXSize - xoff
+        if win_ysize is None:
+            win_ysize = self.RasterYSize - yoff
+        tile = terrain_tile(self.dem_path, xoff, yoff, win_xsize, win_ysize)
+        return tile[TERRAIN_PRODUCTS.index(self.product)]
+
+
+def slope_aspect_sources(slope_input_path, aspect_input_path, dem_input_path=None):
+    # the (slope, aspect) inputs: the grids or, with a DEM, its TerrainSource
+    if dem_input_path:
+        return TerrainSource(dem_input_path, 'slope'), TerrainSource(dem_input_path, 'aspect')
+    if not (slope_input_path and aspect_input_path):
+        raise Exception("The slope and aspect grids or a DEM are required.")
+    return slope_input_path, aspect_input_path
+
+
+def open_raster(source):
+    # the pooled gdal dataset of a raster path (see acquire_dataset), a
+    # TerrainSource as it is; every open_raster needs a close_raster
+    if isinstance(source, TerrainSource):
+        return source
+    return acquire_dataset(source)
+
+
+def close_raster(source):
+    # end the use of a source of open_raster
+    if not isinstance(source, TerrainSource):
+        release_dataset(source)
+
+
+# Tile scheduler
+# Every worker opens its own datasets (the dataset pool is not shared with
+# the forked workers, see _process_dataset_pool), computes the tiles and
+# sends them back: the caller is the only writer of the output image.
+_tile_worker = {}
+
+
+def _open_tile_worker(input_paths, kernel, args, dtype):
+    datasets = [open_raster(path) for path in input_paths]
+    _tile_worker['datasets'] = datasets
+    _tile_worker['bands'] = [ds.GetRasterBand(1) for ds in datasets]
+    _tile_worker['kernel'] = kernel
+    _tile_worker['args'] = tuple(args)
+    _tile_worker['dtype'] = dtype
+
+
+def _compute_tile(window):
+    xoff, yoff, width, height = window
+    arrays = [band.ReadAsArray(xoff, yoff, width, height) for band in _tile_worker['bands']]
+    result = _tile_worker['kernel'](*(arrays + list(_tile_worker['args'])))
+    return window, numpy.asarray(result, dtype=_tile_worker['dtype'])
+
+
+def map_tiles(kernel, input_paths, windows, args=(), workers=1, dtype=numpy.float32):
+    """
+      Compute a kernel on the windows of the input images
+      @param kernel          : function(*input arrays + args), must be a module function
+      @param input_paths     : raster paths or TerrainSource, band 1 of each is
+                               read for every window
+      @param windows         : list of (xoff, yoff, width, height)
+      @param args            : extra arguments of the kernel
+      @param workers         : number of processes, 0 for all the cores
+      @param dtype           : type of the returned arrays
+
+      @return: iterator on (window, array), in the order of the windows
+    """
+    windows = list(windows)
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    workers = min(int(workers), len(windows))
+
+    if workers <= 1:
+        _open_tile_worker(input_paths, kernel, args, dtype)
+        try:
+            for window in windows:
+                yield _compute_tile(window)
+        finally:
+            for path in input_paths:
+                close_raster(path)
+            _tile_worker.clear()
+        return
+
+    # at most 2 tiles for worker are queued or computed ahead of the one
+    # yielded: a writer slower than the workers does not pile up the
+    # tiles of the whole image in memory
+    pool = multiprocessing.Pool(workers, _open_tile_worker, (input_paths, kernel, args, dtype))
+    try:
+        pending = deque()
+        for window in windows:
+            pending.append(pool.apply_async(_compute_tile, (window,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# Output profiles
+# The GTiff creation options of the output images. The overviews are
+# computed from the tiles while they are written (see write_output and
+# StreamedOverviews); a 'cog' profile writes a tiled image with overviews
+# in an intermediate raster and copies it as Cloud Optimized GeoTIFF (the
+# overviews before the full resolution data) in finish_output. The
+# compressions missing in the GDAL library are replaced by DEFLATE.
+OUTPUT_BLOCK_SIZE = 512
+OUTPUT_OVERVIEW_MIN_SIZE = 256      # pixels of the smallest overview
+
+_TILED_OPTIONS = ['TILED=YES',
+                  'BLOCKXSIZE=%d' % OUTPUT_BLOCK_SIZE,
+                  'BLOCKYSIZE=%d' % OUTPUT_BLOCK_SIZE,
+                  'BIGTIFF=IF_SAFER',
+                  'NUM_THREADS=ALL_CPUS']
+
+OUTPUT_PROFILES = OrderedDict([
+    ('deflate', {'options': _TILED_OPTIONS + ['COMPRESS=DEFLATE', 'PREDICTOR=3', 'ZLEVEL=6'],
+                 'overviews': True, 'cog': False}),
+    ('zstd', {'options': _TILED_OPTIONS + ['COMPRESS=ZSTD', 'PREDICTOR=3', 'ZSTD_LEVEL=9'],
+              'overviews': True, 'cog': False}),
+    ('lerc', {'options': _TILED_OPTIONS + ['COMPRESS=LERC_ZSTD', 'MAX_Z_ERROR=0'],
+              'overviews': True, 'cog': False}),
+    ('cog', {'options': _TILED_OPTIONS + ['COMPRESS=DEFLATE', 'PREDICTOR=3', 'ZLEVEL=6'],
+             'overviews': True, 'cog': True}),
+    ('plain', {'options': [],               # striped and uncompressed
+               'overviews': False, 'cog': False}),
+])
+OUTPUT_PROFILE_NAMES = list(OUTPUT_PROFILES)
+
+_outputs = {}       # description of the dataset: (StreamedOverviews, final path or None)
+
+
+def output_creation_options(profile='deflate'):
+    # the GTiff creation options of an output profile
+    options = OUTPUT_PROFILES[profile]['options']
+    compress = [o.split('=', 1)[1] for o in options if o.startswith('COMPRESS=')]
+    supported = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    if compress and compress[0] not in supported:
+        options = OUTPUT_PROFILES['deflate']['options']
+    return list(options)
+
+
+def output_tile_size(profile='deflate'):
+    # the tile size of the computation aligned on the overviews (see
+    # StreamedOverviews), None for the profiles without them
+    return OUTPUT_BLOCK_SIZE if OUTPUT_PROFILES[profile]['overviews'] else None
+
+
+def overview_levels(cols, rows, min_size=None):
+    # the overview factors down to min_size pixels (None: OUTPUT_OVERVIEW_MIN_SIZE)
+    if min_size is None:
+        min_size = OUTPUT_OVERVIEW_MIN_SIZE
+    levels = []
+    level = 2
+    while max(cols, rows) // level >= min_size:
+        levels.append(level)
+        level *= 2
+    return levels
+
+
+def create_output(path, cols, rows, bands=1, data_type=gdal.GDT_Float32, profile='deflate', nodata=-3.4e+38,
+                  scratch_dir=None):
+    """
+      Create an output image with an output profile
+      @param path            : the GTiff path
+      @param profile         : one of OUTPUT_PROFILE_NAMES
+      @param nodata          : value of the empty cells, for the overviews
+      @param scratch_dir     : directory of a big 'cog' intermediate image,
+                               None for the system temporary directory
+
+      @return: the gdal dataset (a 'cog' one is intermediate); the data
+               must be written by write_output and the image completed by
+               finish_output; on success or error the caller ends it with
+               discard_output and, once closed, close_output
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    if OUTPUT_PROFILES[profile]['cog']:
+        final_path = str(path)
+        path = intermediate_raster_path('cog', raster_nbytes(cols, rows, bands, data_type), scratch_dir)
+        options = _TILED_OPTIONS[:4]        # uncompressed, compressed by the copy
+    else:
+        final_path = None
+        options = output_creation_options(profile)
+
+    dst = driver.Create(str(path), cols, rows, bands, data_type, options)
+    if dst is None:
+        raise Exception("Unable to create %s" % path)
+
+    overviews = None
+    if OUTPUT_PROFILES[profile]['overviews']:
+        overviews = StreamedOverviews(dst, overview_levels(cols, rows), nodata)
+    _outputs[dst.GetDescription()] = (overviews, final_path)
+    return dst
+
+
+def write_output(dst, array, xoff=0, yoff=0, band=1):
+    # write a tile of an image of create_output and its overviews
+    dst.GetRasterBand(band).WriteArray(array, xoff, yoff)
+    overviews = _outputs.get(dst.GetDescription(), (None, None))[0]
+    if overviews is not None:
+        overviews.write(band, array, xoff, yoff)
+
+
+def finish_output(dst, profile='deflate'):
+    """
+      Complete an image of create_output, a 'cog' one is copied to its path
+      @param dst             : the gdal dataset of create_output
+      @param profile         : its output profile
+
+      (the image is then ended by discard_output, see create_output)
+    """
+    overviews, final_path = _outputs.get(dst.GetDescription(), (None, None))
+    if overviews is not None:
+        overviews.close()
+    dst.FlushCache()
+
+    if final_path is None:
+        return
+    options = output_creation_options(profile) + ['COPY_SRC_OVERVIEWS=YES']
+    cog = gdal.GetDriverByName('GTiff').CreateCopy(final_path, dst, 0, options)
+    if cog is None:
+        raise Exception("Unable to create %s" % final_path)
+    cog = None
+
+
+def discard_output(dst):
+    # forget an image of create_output, finished or not (its overviews keep
+    # the dataset open); return the path of the intermediate image of a
+    # 'cog' one (None for the others and for dst None), to be removed by
+    # close_output once the caller has closed the dataset
+    if dst is None:
+        return None
+    overviews, final_path = _outputs.pop(dst.GetDescription(), (None, None))
+    if final_path is None:
+        return None
+    return dst.GetDescription()
+
+
+def close_output(intermediate_path):
+    # remove the intermediate image of discard_output, after the caller has
+    # closed it (an open file cannot be removed on Windows)
+    if intermediate_path is not None:
+        remove_intermediate_raster(intermediate_path)
+
+
+class StreamedOverviews:
+    # The overviews of an output image computed from its tiles while they
+    # are written: the mean of the valid pixels of each block of
+    # factor x factor pixels. The blocks inside a tile give their overview
+    # pixels at once; the ones across the tile borders are summed in
+    # memory up to their last pixel, so the memory is bounded by the
+    # borders of the tiles still to write, not by the overview size.
+
+    def __init__(self, dst, levels, nodata=None):
+        self.dst = dst
+        self.levels = levels
+        self.nodata = nodata
+        self.cols, self.rows = dst.RasterXSize, dst.RasterYSize
+        self.partial = {}       # (band, level, y, x): [sum, count, pixels] of a border block
+        if levels:
+            dst.BuildOverviews('NONE', levels)  # the empty overview bands
+
+    def _valid(self, array):
+        # the array as float64 with nan in place of nodata; nodata is
+        # compared in the type of the array (-3.4e+38 is not the same
+        # number in float32 and float64)
+        invalid = ~numpy.isfinite(array) if array.dtype.kind == 'f' else numpy.zeros(array.shape, dtype=bool)
+        if self.nodata is not None:
+            nodata = numpy.asarray(self.nodata).astype(array.dtype) if array.dtype.kind == 'f' else self.nodata
+            invalid |= array == nodata
+        array = array.astype(numpy.float64)
+        array[invalid] = numpy.nan
+        return array
+
+    def _blocks(self, array, factor, xoff, yoff):
+        # sums and counts of the valid pixels by block of the overview grid
+        left, top = xoff % factor, yoff % factor
+        height, width = array.shape
+        rows = (top + height + factor - 1) // factor
+        cols = (left + width + factor - 1) // factor
+
+        padded = numpy.empty((rows * factor, cols * factor), dtype=numpy.float64)
+        padded.fill(numpy.nan)
+        padded[top:top + height, left:left + width] = array
+
+        blocks = padded.reshape(rows, factor, cols, factor)
+        valid = ~numpy.isnan(blocks)
+        counts = valid.sum(axis=3).sum(axis=1)
+        sums = numpy.where(valid, blocks, 0).sum(axis=3).sum(axis=1)
+        return sums, counts
+
+    def _mean(self, sums, counts):
+        fill = numpy.nan if self.nodata is None else self.nodata
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.where(counts > 0, sums / counts, fill)
+
+    def _span(self, offset, length, size, factor):
+        # for each block of the overview grid crossed by [offset, offset +
+        # length): the pixels of the block in the span, and in the image
+        first = offset // factor
+        starts = numpy.arange(first, (offset + length + factor - 1) // factor) * factor
+        ends = numpy.minimum(starts + factor, size)
+        inside = numpy.minimum(ends, offset + length) - numpy.maximum(starts, offset)
+        return first, inside, ends - starts
+
+    def write(self, band, array, xoff, yoff):
+        array = self._valid(array)
+        height, width = array.shape
+        for i, factor in enumerate(self.levels):
+            overview = self.dst.GetRasterBand(band).GetOverview(i)
+            sums, counts = self._blocks(array, factor, xoff, yoff)
+            y0, rows_inside, rows_block = self._span(yoff, height, self.rows, factor)
+            x0, cols_inside, cols_block = self._span(xoff, width, self.cols, factor)
+
+            # the blocks inside the tile, a rectangle: only the first and
+            # last row/column may cross the tile borders
+            full_rows = numpy.flatnonzero(rows_inside == rows_block)
+            full_cols = numpy.flatnonzero(cols_inside == cols_block)
+            if full_rows.size and full_cols.size:
+                r0, r1 = full_rows[0], full_rows[-1] + 1
+                c0, c1 = full_cols[0], full_cols[-1] + 1
+                overview.WriteArray(self._mean(sums[r0:r1, c0:c1], counts[r0:r1, c0:c1]), x0 + c0, y0 + r0)
+
+            # the blocks across the tile borders
+            border = set((r, c) for r in numpy.flatnonzero(rows_inside != rows_block)
+                         for c in range(len(cols_inside)))
+            border.update((r, c) for r in range(len(rows_inside))
+                          for c in numpy.flatnonzero(cols_inside != cols_block))
+            for r, c in border:
+                key = (band, factor, y0 + r, x0 + c)
+                block = self.partial.setdefault(key, [0.0, 0, 0])
+                block[0] += sums[r, c]
+                block[1] += counts[r, c]
+                block[2] += rows_inside[r] * cols_inside[c]
+                if block[2] == rows_block[r] * cols_block[c]:
+                    self._write_block(key)
+
+    def _write_block(self, key):
+        band, factor, y, x = key
+        total, count, pixels = self.partial.pop(key)
+        overview = self.dst.GetRasterBand(band).GetOverview(self.levels.index(factor))
+        mean = self._mean(numpy.array([[total]]), numpy.array([[count]]))
+        overview.WriteArray(mean, x, y)
+
+    def close(self):
+        # write the border blocks of the tiles not written
+        for key in list(self.partial):
+            self._write_block(key)
+
+
+class BlockCache:
+    # The size of the GDAL block cache during a run (0 to leave it as it
+    # is): the cache belongs to the whole QGIS process, the previous size
+    # is restored at the end.
+
+    def __init__(self, megabytes):
+        self.megabytes = megabytes
+        self.previous = None
+
+    def __enter__(self):
+        if self.megabytes:
+            self.previous = gdal.GetCacheMax()
+            gdal.SetCacheMax(int(self.megabytes) * 1024 * 1024)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.previous is not None:
+            gdal.SetCacheMax(self.previous)
+
+
+# Output parameters
+# The advanced parameters of the algorithms writing output images, the
+# same for all of them (see add_output_parameters and output_parameters).
+OUTPUT_PROFILE = "OUTPUT_PROFILE"
+BLOCK_CACHE = "BLOCK_CACHE"
+SCRATCH_DIR = "SCRATCH_DIR"
+
+
+def add_output_parameters(alg):
+    # add the output profile, the block cache and the scratch folder to a
+    # GeoAlgorithm (processing is imported here, it is only in QGIS)
+    from processing.core.parameters import ParameterSelection
+    from processing.core.parameters import ParameterNumber
+    from processing.core.parameters import ParameterFile
+
+    output_profile = ParameterSelection(OUTPUT_PROFILE,
+                                        "Output profile (GTiff creation options)",
+                                        OUTPUT_PROFILE_NAMES,
+                                        default=0)
+    block_cache = ParameterNumber(BLOCK_CACHE,
+                                  "GDAL block cache (MB, 0: GDAL default)",
+                                  minValue=0,
+                                  default=0)
+    scratch_dir = ParameterFile(SCRATCH_DIR,
+                                "Folder of the big intermediate images (empty: temporary folder)",
+                                isFolder=True,
+                                optional=True)
+    for param in (output_profile, block_cache, scratch_dir):
+        param.isAdvanced = True
+        alg.addParameter(param)
+
+
+def output_parameters(alg):
+    # the values of add_output_parameters: (output profile name, block
+    # cache MB for BlockCache, scratch folder or None)
+    output_profile = OUTPUT_PROFILE_NAMES[alg.getParameterValue(OUTPUT_PROFILE)]
+    block_cache = alg.getParameterValue(BLOCK_CACHE)
+    scratch_dir = alg.getParameterValue(SCRATCH_DIR)
+    scratch_dir = str(scratch_dir) if scratch_dir else None
+    return output_profile, block_cache, scratch_dir
+
+
+# Speed kernels
+# The cosine directors are folded in two scalar coefficients for each
+# speed component, computed in a float32 output array by chunks of rows
+# to bound the temporaries.
+SPEED_CHUNK_CELLS = 1024 * 1024
+
+def speed_coefficients(cd_e_asc, cd_h_asc, cd_e_desc, cd_h_desc):
+    """
+      Coefficients of the speed components for the system of the two geometries
+          asc  = cd_e_asc  * EW + cd_h_asc  * H
+          desc = cd_e_desc * EW + cd_h_desc * H
+
+      @return: ((k_asc, k_desc) of EW, (k_asc, k_desc) of H), so that
+               EW = k_asc * asc + k_desc * desc and the same for H
+    """
+    det = float(cd_e_asc) * cd_h_desc - float(cd_h_asc) * cd_e_desc
+    if det == 0:
+        raise Exception("The cosine directors of the two geometries are parallel.")
+    return ((cd_h_desc / det, - cd_h_asc / det),
+            (- cd_e_desc / det, cd_e_asc / det))
+
+
+def combine_speed(asc_array, desc_array, k_asc, k_desc, out=None):
+    # k_asc * asc + k_desc * desc in a (preallocated) float32 array
+    if out is None:
+        out = numpy.empty(asc_array.shape, dtype=numpy.float32)
+
+    rows = asc_array.shape[0]
+    step = max(1, SPEED_CHUNK_CELLS // max(1, asc_array[0:1].size))
+    for start in range(0, rows, step):
+        chunk = out[start:start + step]
+        numpy.multiply(asc_array[start:start + step], k_asc, chunk)
+        chunk += k_desc * desc_array[start:start + step]
+    return out
+
+
+def cosine_director(value):
+    # a cosine director as a number for the whole scene, or as the path
+    # of a raster of the line of sight (see solve_speed)
+    if isinstance(value, numbers.Number):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        return str(value)
+
+
+def grid_values(source, extent, cell_size, row_start, rows):
+    """
+      The values of a source at the cell centres of some rows of the
+      north up grid of an extent (see grid_points)
+      @param source          : a number, or the path of a raster sampled at
+                               the nearest pixel (nan outside and on nodata)
+      @param row_start, rows : the rows of the grid
+
+      @return: the number as it is, else a numpy float64 array (rows, cols)
+    """
+    if isinstance(source, numbers.Number):
+        return source
+
+    xmin, ymin, xmax, ymax = extent
+    cols = extent_size(extent, cell_size)[0]
+    xs = xmin + (numpy.arange(cols) + 0.5) * cell_size
+    ys = ymax - (numpy.arange(row_start, row_start + rows) + 0.5) * cell_size
+
+    ds = acquire_dataset(source)
+    try:
+        values = sample_raster_at_points(ds, numpy.tile(xs, rows), numpy.repeat(ys, cols))
+    finally:
+        release_dataset(source)
+    return values.reshape(rows, cols)
+
+
+def solve_speed(asc_array, desc_array, cosine_directors, extent, cell_size, component, out=None):
+    """
+      A speed component of the system of the two geometries (see
+      speed_coefficients) with numbers or rasters as cosine directors
+      @param asc_array, desc_array : the gridded velocities of the extent
+      @param cosine_directors      : (cd_e_asc, cd_h_asc, cd_e_desc, cd_h_desc),
+                                     each one as cosine_director
+      @param component             : 0 for East-West, 1 for horizontal
+      @param out                   : preallocated float32 array
+
+      @return: float32 array, nan where the geometries are parallel; the
+               rasters are read a chunk of rows at a time, the numbers
+               are not expanded to arrays
+    """
+    outs = None if out is None else [out]
+    return solve_speeds(asc_array, desc_array, cosine_directors, extent, cell_size, [component], outs)[0]
+
+
+def solve_speeds(asc_array, desc_array, cosine_directors, extent, cell_size, components=(0, 1), outs=None):
+    """
+      Some speed components in a single pass over the grids and the
+      cosine director rasters (see solve_speed)
+      @param components      : list of components, 0 for East-West, 1 for
+                               horizontal
+      @param outs            : preallocated float32 arrays, one for component
+
+      @return: list of float32 arrays, one for component
+    """
+    cds = [cosine_director(cd) for cd in cosine_directors]
+    constant = all(isinstance(cd, numbers.Number) for cd in cds)
+    if constant:
+        coefficients = speed_coefficients(*cds)
+
+    if outs is None:
+        outs = [numpy.empty(asc_array.shape, dtype=numpy.float32) for component in components]
+
+    rows = asc_array.shape[0]
+    step = max(1, SPEED_CHUNK_CELLS // max(1, asc_array[0:1].size))
+    for start in range(0, rows, step):
+        asc = asc_array[start:start + step]
+        desc = desc_array[start:start + step]
+        if constant:
+            for component, out in zip(components, outs):
+                k_asc, k_desc = coefficients[component]
+                combine_speed(asc, desc, k_asc, k_desc, out[start:start + step])
+            continue
+
+        # each raster is sampled once for all the components
+        e_asc, h_asc, e_desc, h_desc = [grid_values(cd, extent, cell_size, start, len(asc)) for cd in cds]
+        det = e_asc * h_desc - h_asc * e_desc
+        for component, out in zip(components, outs):
+            if component == 0:
+                numerator = h_desc * asc - h_asc * desc
+            else:
+                numerator = e_asc * desc - e_desc * asc
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                out[start:start + step] = numpy.where(det != 0, numerator / det, numpy.nan)
+    return outs
 
     
 def extent_size(extent, cell_size):
@@ -149,12 +1310,348 @@ def addFieldManagement(ds, fname, ftype):
 
 def calculateFieldManagement(ds, fname, fvalue):
     # set a constant value to a field for each point in layer 0
-    layer = ds.GetLayer(0)
-    layer.SetNextByIndex(0) # reset index
+    write_layer_columns(ds.GetLayer(0), {fname: fvalue})
+
+
+
+# Columnar access
+# The points of a layer are read in one pass as numpy arrays (only the
+# fields asked, the others are ignored by the driver) and the computed
+# columns are written back in one pass; the big layers are streamed a chunk of
+# features at a time to a new layer (read_layer_chunks, PointsWriter).
+WRITE_COMMIT_INTERVAL = 20000     # features for transaction
+STREAM_CHUNK_SIZE = 100000        # features for chunk (see read_layer_chunks)
+
+def _field_names(layer, names):
+    # the names of the fields as written in the layer (the lookup is case
+    # insensitive)
+    layer_defn = layer.GetLayerDefn()
+    fields = {}
+    for name in names:
+        index = layer_defn.GetFieldIndex(name)
+        if index < 0:
+            raise Exception("Field %s not found." % name)
+        fields[name] = layer_defn.GetFieldDefn(index).GetName()
+    return fields
+
+
+def read_layer_columns(layer, names=(), geometry=True):
+    """
+      Read the coordinates and some fields of every point in a layer in one pass
+      @param layer           : ogr point layer
+      @param names           : field names to read (as float)
+      @param geometry        : read the coordinates too
+
+      @return: (x, y, columns); x, y numpy arrays in map units (None
+               without geometry), columns a dictionary name:numpy float
+               array (null -> nan)
+    """
+    fields = _field_names(layer, names)
+    layer_defn = layer.GetLayerDefn()
+    ignored = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())
+               if layer_defn.GetFieldDefn(i).GetName() not in fields.values()]
+    if not geometry:
+        ignored.append('OGR_GEOMETRY')
+
+    indexes = dict((name, layer_defn.GetFieldIndex(field)) for name, field in fields.items())
+    xs, ys = [], []
+    values = dict((name, []) for name in names)
+
+    layer.SetIgnoredFields(ignored)
+    try:
+        layer.ResetReading()
+        for feat in layer:
+            if geometry:
+                geom = feat.GetGeometryRef()
+                xs.append(geom.GetX())
+                ys.append(geom.GetY())
+            for name, index in indexes.items():
+                value = feat.GetField(index)
+                values[name].append(numpy.nan if value is None else value)
+    finally:
+        layer.SetIgnoredFields([])
+        layer.ResetReading()
+
+    columns = dict((name, numpy.array(values[name], dtype=numpy.float64)) for name in names)
+    if not geometry:
+        return None, None, columns
+    return numpy.array(xs, dtype=numpy.float64), numpy.array(ys, dtype=numpy.float64), columns
+
+
+class LayerTransaction:
+    # Group the feature updates or insertions of a layer in transactions of
+    # commit_interval features, when the layer supports them (GeoPackage,
+    # PostGIS, ...). On error only the open transaction is rolled back:
+    # the ones already committed stay, so the layer is left partially
+    # written (and without transactions, e.g. ESRI Shapefile, nothing is
+    # rolled back).
+
+    def __init__(self, layer, commit_interval=None):
+        self.layer = layer
+        self.commit_interval = commit_interval or WRITE_COMMIT_INTERVAL
+        self.transactions = bool(layer.TestCapability(ogr.OLCTransactions))
+        self.count = 0
+
+    def update(self, feat):
+        self.layer.SetFeature(feat)
+        self._count()
+
+    def create(self, feat):
+        self.layer.CreateFeature(feat)
+        self._count()
+
+    def _count(self):
+        self.count += 1
+        if self.transactions and self.count % self.commit_interval == 0:
+            self.layer.CommitTransaction()
+            self.layer.StartTransaction()
+
+    def __enter__(self):
+        if self.transactions:
+            self.layer.StartTransaction()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.transactions:
+            if exc_type is None:
+                self.layer.CommitTransaction()
+            else:
+                self.layer.RollbackTransaction()
+
+
+def _column_fields(layer, columns, count):
+    # create the missing fields of columns as real, return a list of
+    # (field index, list of values or None, constant value)
+    layer_defn = layer.GetLayerDefn()
+    for name in columns:
+        if layer_defn.GetFieldIndex(name) < 0:
+            addFieldDefn(layer, name, ogr.OFTReal)
+    layer_defn = layer.GetLayerDefn()
+
+    fields = []
+    for name, column in columns.items():
+        column = numpy.asarray(column, dtype=numpy.float64)
+        if column.ndim == 0:
+            value = float(column) if numpy.isfinite(column) else None
+            fields.append((layer_defn.GetFieldIndex(name), None, value))
+        elif len(column) != count:
+            raise Exception("Field %s: %d values for %d points." % (name, len(column), count))
+        else:
+            # nan and inf as nan, written as null
+            column = numpy.where(numpy.isfinite(column), column, numpy.nan)
+            fields.append((layer_defn.GetFieldIndex(name), column.tolist(), None))
+    return fields
+
+
+def _set_column_fields(feat, fields, i):
+    # set the values of the i-th point (nan -> null, see _column_fields)
+    for index, values, value in fields:
+        if values is not None:
+            value = values[i]
+            if value != value:      # nan -> null
+                value = None
+        if value is None:
+            feat.UnsetField(index)
+        else:
+            feat.SetField(index, value)
+
+
+def write_layer_columns(layer, columns, commit_interval=None):
+    """
+      Write some columns in the points of a layer in one pass, in the layer
+      order, in transactions of commit_interval features (see LayerTransaction);
+      on error the layer is left partially written, only the features of the
+      last transaction are rolled back
+      @param layer           : ogr point layer
+      @param columns         : dictionary name:numpy array or scalar; the
+                               missing fields are created as real, nan
+                               and inf values are set as null
+      @param commit_interval : features for transaction, None for
+                               WRITE_COMMIT_INTERVAL
+    """
+    fields = _column_fields(layer, columns, layer.GetFeatureCount())
+
+    layer.ResetReading()
+    with LayerTransaction(layer, commit_interval) as transaction:
+        for i, feat in enumerate(layer):
+            _set_column_fields(feat, fields, i)
+            transaction.update(feat)  # update!
+
+
+# The OGR drivers of the vector outputs for the extension of their path,
+# ESRI Shapefile for the others
+VECTOR_DRIVERS = {
+    '.shp': "ESRI Shapefile",
+    '.gpkg': "GPKG",
+    '.sqlite': "SQLite",
+    '.geojson': "GeoJSON",
+}
+
+
+def vector_driver(path):
+    # the OGR driver of a vector output (see VECTOR_DRIVERS)
+    extension = os.path.splitext(path)[1].lower()
+    return ogr.GetDriverByName(VECTOR_DRIVERS.get(extension, "ESRI Shapefile"))
+
+
+class PointsWriter:
+    # Write the points of a layer with some new real fields in a new vector
+    # file (the driver from its extension, see vector_driver), appending a
+    # chunk of features at a time, in transactions of commit_interval
+    # features when the driver supports them (GeoPackage, SQLite; see
+    # LayerTransaction). On error the output keeps the features appended
+    # so far: it is not a complete result and has to be written again.
+
+    def __init__(self, layer, shape_output_path, names, commit_interval=None):
+        driver = vector_driver(shape_output_path)
+        self.output_ds = driver.CreateDataSource(shape_output_path)
+        self.layer = self.output_ds.CreateLayer(layer.GetName(), layer.GetSpatialRef(), layer.GetGeomType())
+        layer_defn = layer.GetLayerDefn()
+        for i in range(layer_defn.GetFieldCount()):
+            self.layer.CreateField(layer_defn.GetFieldDefn(i))
+        for name in names:
+            if self.layer.GetLayerDefn().GetFieldIndex(name) < 0:
+                addFieldDefn(self.layer, name, ogr.OFTReal)
+        self.transaction = LayerTransaction(self.layer, commit_interval)
+
+    def append(self, features, columns, count=None):
+        # append the features (of the input layer) with the columns, a
+        # dictionary name:numpy array or scalar in the features order
+        # (see write_layer_columns); count: None for len(features)
+        if count is None:
+            count = len(features)
+        fields = _column_fields(self.layer, columns, count)
+        layer_defn = self.layer.GetLayerDefn()
+        for i, feat in enumerate(features):
+            output_feat = ogr.Feature(layer_defn)
+            output_feat.SetFrom(feat)
+            _set_column_fields(output_feat, fields, i)
+            self.transaction.create(output_feat)
+
+    def __enter__(self):
+        self.transaction.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.transaction.__exit__(exc_type, exc_val, exc_tb)
+
+
+# Statistics of the fields, as the GDAL STATISTICS_* items of the rasters
+HISTOGRAM_BUCKETS = 20
+
+
+class ArrayStatistics:
+    # Minimum, maximum, mean and histogram of the finite values of a field,
+    # updated an array (or a chunk) at a time; the histogram range is
+    # fixed in advance, the values outside it go to the first/last bucket.
+
+    def __init__(self, hist_min, hist_max, buckets=None):
+        self.hist_min = float(hist_min)
+        self.hist_max = float(hist_max)
+        self.buckets = buckets or HISTOGRAM_BUCKETS
+        self.histogram = numpy.zeros(self.buckets, dtype=numpy.int64)
+        self.minimum = None
+        self.maximum = None
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, array):
+        array = numpy.asarray(array, dtype=numpy.float64)
+        array = array[numpy.isfinite(array)]
+        if not array.size:
+            return
+        minimum, maximum = float(array.min()), float(array.max())
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+        self.total += float(array.sum())
+        self.count += array.size
+        self.histogram += numpy.histogram(numpy.clip(array, self.hist_min, self.hist_max),
+                                          self.buckets, (self.hist_min, self.hist_max))[0]
+
+    def metadata(self, name):
+        # the statistics as metadata items of the field name
+        if not self.count:
+            return OrderedDict([('%s_VALID_COUNT' % name, '0')])
+        return OrderedDict([
+            ('%s_MINIMUM' % name, repr(self.minimum)),
+            ('%s_MAXIMUM' % name, repr(self.maximum)),
+            ('%s_MEAN' % name, repr(self.total / self.count)),
+            ('%s_VALID_COUNT' % name, str(self.count)),
+            ('%s_HISTOGRAM_MIN' % name, repr(self.hist_min)),
+            ('%s_HISTOGRAM_MAX' % name, repr(self.hist_max)),
+            ('%s_HISTOGRAM' % name, ','.join(str(n) for n in self.histogram)),
+        ])
+
+
+def write_layer_metadata(output_ds, shape_output_path, items):
+    """
+      Write some metadata items in the first layer of a vector file; the
+      ESRI Shapefiles do not keep the layer metadata, so the items are
+      written in the <name>.stats.json sidecar too
+      @param output_ds       : ogr data source opened for writing
+      @param shape_output_path : its path
+      @param items           : dictionary name:string value
+    """
+    layer = output_ds.GetLayer(0)
+    for name, value in items.items():
+        layer.SetMetadataItem(name, value)
+
+    sidecar_path = '%s.stats.json' % os.path.splitext(shape_output_path)[0]
+    with open(sidecar_path, 'w') as sidecar:
+        json.dump(items, sidecar, indent=2)
+
+
+def _layer_chunk(features, indexes, geometry=True):
+    # coordinates (None without geometry) and fields of a list of point
+    # features as numpy arrays
+    count = len(features)
+    xs = numpy.empty(count, dtype=numpy.float64) if geometry else None
+    ys = numpy.empty(count, dtype=numpy.float64) if geometry else None
+    columns = dict((name, numpy.empty(count, dtype=numpy.float64)) for name in indexes)
+    for i, feat in enumerate(features):
+        if geometry:
+            geom = feat.GetGeometryRef()
+            xs[i] = geom.GetX()
+            ys[i] = geom.GetY()
+        for name, index in indexes.items():
+            value = feat.GetField(index)
+            columns[name][i] = numpy.nan if value is None else value
+    return features, xs, ys, columns
+
+
+def read_layer_chunks(layer, names=(), chunk_size=None, geometry=True):
+    """
+      Read the points of a layer sequentially, a chunk of features at a
+      time, so that the memory is bounded by the chunk size
+      @param layer           : ogr point layer
+      @param names           : field names to read (as float)
+      @param chunk_size      : features for chunk, None for STREAM_CHUNK_SIZE
+      @param geometry        : read the coordinates too
+
+      @return: generator of (features, x, y, columns) for each chunk, the
+               list of the features and the arrays as read_layer_columns
+    """
+    chunk_size = int(chunk_size or STREAM_CHUNK_SIZE)
+    layer_defn = layer.GetLayerDefn()
+    indexes = dict((name, layer_defn.GetFieldIndex(field))
+                   for name, field in _field_names(layer, names).items())
+
+    layer.ResetReading()
+    features = []
     for feat in layer:
-        #print 'feat:', fname, fvalue
-        feat.SetField(fname, fvalue)
-        layer.SetFeature(feat)         # update!!!
+        features.append(feat)
+        if len(features) == chunk_size:
+            yield _layer_chunk(features, indexes, geometry)
+            features = []
+    if features:
+        yield _layer_chunk(features, indexes, geometry)
+
+
+def read_points_as_arrays(layer):
+    # read the coordinates of every point in the layer in one pass,
+    # return the numpy arrays x, y (map units)
+    xs, ys, columns = read_layer_columns(layer)
+    return xs, ys
 
 
         
@@ -171,34 +1668,69 @@ def ApplyGeoTransform(inx, iny, gt):
     return (outx, outy)
 
     
-def setFieldFromRasterPoints(src_ds, ds, fieldname):
-    # copy value from a raster image to relative point in a vectorial image
-    # src_ds: gdal raster obj
-    # ds: ogr shp image
+def sample_raster_at_points(src_ds, xs, ys, band=1):
+    """
+      Sample a raster image at the given points
+      Only the raster blocks containing at least a point are read.
+      @param src_ds          : gdal raster obj (no rotation)
+      @param xs, ys          : numpy arrays of coordinates in map units
+      @param band            : band number
 
+      @return: numpy float64 array, nan for points outside the image and
+               on nodata
+    """
     gt = src_ds.GetGeoTransform()
-    rb = src_ds.GetRasterBand(1)
+    rb = src_ds.GetRasterBand(band)
+    nodata = band_nodata(rb)
+    cols, rows = src_ds.RasterXSize, src_ds.RasterYSize
+    block_width, block_height = rb.GetBlockSize()
 
-    layer = ds.GetLayer(0)
-    layer.SetNextByIndex(0)  # reset index
+    values = numpy.empty(len(xs), dtype=numpy.float64)
+    values.fill(numpy.nan)
 
-    #
-    for feat in layer:
-        geom = feat.GetGeometryRef()
-        mx,my = geom.GetX(), geom.GetY()  #coord in map units
+    # pixel coordinates
+    px = numpy.floor((xs - gt[0]) / gt[1]).astype(numpy.int64)
+    py = numpy.floor((ys - gt[3]) / gt[5]).astype(numpy.int64)
+    inside = numpy.flatnonzero((px >= 0) & (px < cols) & (py >= 0) & (py < rows))
+    if not len(inside):
+        return values
 
-        # no rotation
-        px = int((mx - gt[0]) / gt[1]) #x pixel
-        py = int((my - gt[3]) / gt[5]) #y pixel
-        p1x, p1y = ApplyGeoTransform(mx, my, gt)
+    # group the points by block
+    blocks_per_row = (cols + block_width - 1) // block_width
+    block_ids = (py[inside] // block_height) * blocks_per_row + px[inside] // block_width
+    order = numpy.argsort(block_ids, kind='mergesort')
+    inside, block_ids = inside[order], block_ids[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], block_ids[1:] != block_ids[:-1])))
+    ends = numpy.concatenate((starts[1:], [len(block_ids)]))
 
-        # source value is float
-        structval = rb.ReadRaster(px,py,1,1,buf_type=gdal.GDT_Float32)
-        val = struct.unpack('f' , structval)[0]
+    for start, end in zip(starts, ends):
+        block_id = int(block_ids[start])
+        xoff = (block_id % blocks_per_row) * block_width
+        yoff = (block_id // blocks_per_row) * block_height
+        block = rb.ReadAsArray(xoff, yoff,
+                               min(block_width, cols - xoff),
+                               min(block_height, rows - yoff))
+        points = inside[start:end]
+        sampled = block[py[points] - yoff, px[points] - xoff]
+        if nodata is not None:
+            points = points[sampled != nodata]     # in the type of the pixels
+            sampled = sampled[sampled != nodata]
+        values[points] = sampled
 
-        # set fieldname and value
-        addFieldManagement(ds, fieldname, ogr.OFTReal)
-        calculateFieldManagement(ds, fieldname, val)
+    return values
+
+
+def setFieldFromRasterPoints(src_ds, ds, fieldname):
+    # copy value from a raster image to relative point in a vectorial image
+    # src_ds: gdal raster obj
+    # ds: ogr shp image
+
+    layer = ds.GetLayer(0)
+    xs, ys = read_points_as_arrays(layer)
+    values = sample_raster_at_points(src_ds, xs, ys)
+
+    # set fieldname and values
+    write_layer_columns(layer, {fieldname: values})
 
 
 def evaluate(formula, values):
@@ -212,33 +1744,135 @@ def evaluate(formula, values):
     return eval(formula) # this is a little dangerous
 
 
-def real_CalculateField_management(ds, dst_feat_name, formula, feat_names):
+# Formula engine
+# The formula is parsed once and compiled to numpy operations, then
+# evaluated on whole columns instead of one eval per feature.
+FORMULA_FIELD_RE = re.compile(r'\[([^\[\]]+)\]')
+
+FORMULA_FUNCTIONS = {
+    'sin': numpy.sin,
+    'cos': numpy.cos,
+    'tan': numpy.tan,
+    'asin': numpy.arcsin,
+    'acos': numpy.arccos,
+    'atan': numpy.arctan,
+    'atan2': numpy.arctan2,
+    'sqrt': numpy.sqrt,
+    'exp': numpy.exp,
+    'log': numpy.log,
+    'abs': numpy.abs,
+    'fabs': numpy.abs,
+}
+
+FORMULA_BINOPS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,    # same division semantics of eval()
+    ast.Pow: lambda a, b: a ** b,
+    ast.Mod: lambda a, b: a % b,
+}
+
+FORMULA_UNARYOPS = {
+    ast.USub: lambda a: -a,
+    ast.UAdd: lambda a: +a,
+}
+
+
+def _compile_node(node, names):
+    # return a function(columns) for the ast node
+    if isinstance(node, ast.Expression):
+        return _compile_node(node.body, names)
+
+    if isinstance(node, ast.BinOp) and type(node.op) in FORMULA_BINOPS:
+        op = FORMULA_BINOPS[type(node.op)]
+        left = _compile_node(node.left, names)
+        right = _compile_node(node.right, names)
+        return lambda columns: op(left(columns), right(columns))
+
+    if isinstance(node, ast.UnaryOp) and type(node.op) in FORMULA_UNARYOPS:
+        op = FORMULA_UNARYOPS[type(node.op)]
+        operand = _compile_node(node.operand, names)
+        return lambda columns: op(operand(columns))
+
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+            and node.func.id in FORMULA_FUNCTIONS and not node.keywords:
+        func = FORMULA_FUNCTIONS[node.func.id]
+        args = [_compile_node(arg, names) for arg in node.args]
+        return lambda columns: func(*[arg(columns) for arg in args])
+
+    if isinstance(node, ast.Name) and node.id in names:
+        name = names[node.id]
+        return lambda columns: columns[name]
+
+    # ast.Num up to python 3.7, ast.Constant later
+    value = getattr(node, 'n', getattr(node, 'value', None))
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return lambda columns: value
+
+    raise Exception("Unsupported expression in formula: %s" % ast.dump(node))
+
+
+def compile_formula(formula):
     """
-      Eval the formula for each point in the layer 0 of a raster image
-      @param ds              : raster image
+      Compile a formula with params as [field_name] to a function
+      @param formula         : math formula, params as [field_name]
+
+      @return: (function, field names); the function takes a dictionary
+               field_name:numpy array and returns the result array
+    """
+    keys = {}   # field_name:identifier
+    def _placeholder(match):
+        return keys.setdefault(match.group(1), '_f%d' % len(keys))
+
+    source = FORMULA_FIELD_RE.sub(_placeholder, formula)
+    tree = ast.parse(source.strip(), mode='eval')
+    names = dict((key, name) for name, key in keys.items())
+    return _compile_node(tree, names), sorted(keys)
+
+
+def evaluate_columns(formula, columns):
+    # eval the formula on the columns, a dictionary name:numpy array or
+    # scalar (division by zero gives inf)
+    func, names = compile_formula(formula)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return func(columns)
+
+
+def real_CalculateField_management(ds, dst_feat_name, formula, feat_names,
+                                   round_values=False, commit_interval=None):
+    """
+      Eval the formula for each point in the layer 0 of a vector file
+      @param ds              : ogr data source of points
       @param dst_feat_name   : destination field name
       @param formula         : math formula, params as [field_name]
       @param feat_names      : field names present in the layer
+      @param round_values    : round the values to '%.5f' as evaluate does
+      @param commit_interval : features for transaction, None for
+                               WRITE_COMMIT_INTERVAL (see write_layer_columns)
     """
 
     layer = ds.GetLayer(0)
-    layer.SetNextByIndex(0) # reset index
 
-    values = {}
-
-    for feat in layer:
+    func, names = compile_formula(formula)
+    unknown = [name for name in names if name not in feat_names]
+    if unknown:
+        raise Exception("Unknown fields in formula: %s" % ', '.join(unknown))
 
-        for name in feat_names:
-            values[name] = feat.GetField(name)
+    xs, ys, columns = read_layer_columns(layer, names, geometry=False)
+    if round_values:
+        for name, column in columns.items():
+            columns[name] = numpy.char.mod('%.5f', column).astype(numpy.float64)
 
-        result = evaluate(formula, values)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        result = func(columns)
 
-        feat.SetField(dst_feat_name, result)
-        layer.SetFeature(feat)  # update!
+    # a constant result is broadcast
+    write_layer_columns(layer, {dst_feat_name: result}, commit_interval)
 
     
 if __name__ == '__main__':
     import sys
     print clip_from_extent_as_array(
               sys.argv[1],
-              [373880.161999, 5033158.31312, 374757.398705, 5032431.85147])
+              [373880.161999, 5032431.85147, 374757.398705, 5033158.31312])